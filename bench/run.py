@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+
+"""
+Benchmarks of the encode and decode hot paths, reporting throughput in MB/s and
+objects/s for each input size, and comparing against baselines saved on this
+machine with --save, if any, to detect regressions
+
+Each benchmark builds its input of roughly the given size up front, then times
+the best of a number of repeats over it.
+"""
+
+from mot import MotObject, ContentType
+from msc import calculate_crc
+from msc.datagroups import Datagroup, ConstantSegmentSize, CompletionTriggerSegmentingStrategy, PacketAlignedSegmentingStrategy, _segment
+from msc.datagroups import encode_headermode, encode_directorymode, decode_datagroups, BODY
+from msc.packets import Packet, encode_packets, iter_packets, decode_packets
+from bitarray import bitarray
+import argparse
+import json
+import os
+import sys
+import time
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+OBJECT_SIZE = 10000 # body size of the objects in the object encoding benchmarks
+
+def _sizes(s):
+    """parse a size such as 1K, 10M or 1048576 into bytes"""
+    units = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30}
+    if s[-1].upper() in units: return int(float(s[:-1]) * units[s[-1].upper()])
+    return int(s)
+
+def _label(size):
+    for unit, n in (('G', 1 << 30), ('M', 1 << 20), ('K', 1 << 10)):
+        if size >= n and size % n == 0: return '%d%s' % (size // n, unit)
+    return str(size)
+
+def _body(size):
+    """a body of the given size, built from a repeated pattern"""
+    pattern = bytes(bytearray(i % 251 for i in range(min(size, 1 << 16))))
+    return (pattern * (size // len(pattern) + 1))[:size] if pattern else b''
+
+def _objects(size):
+    """MOT objects with bodies totalling about the given size"""
+    n = max(1, size // OBJECT_SIZE)
+    body = _body(min(size, OBJECT_SIZE))
+    return [MotObject('BenchObject%d' % i, body, ContentType.IMAGE_JFIF) for i in range(n)]
+
+def _datagroups(size):
+    """body datagroups of maximum size segments totalling about the given size"""
+    return [Datagroup(1, BODY, segment, i, i % 16, last=False) for i, segment in enumerate(_segment(_body(size), ConstantSegmentSize()))]
+
+def _capture(size):
+    """a packet capture of about the given size, as a repeated carousel of encoded packets"""
+    datagroups = encode_directorymode(_objects(min(size, 1 << 20)))
+    continuity = {}
+    # four cycles end on the continuity index they start from, so they can be repeated seamlessly
+    cycles = b''.join(packet.tobytes() for _ in range(4) for packet in iter_packets(datagroups, 1, Packet.SIZE_96, continuity))
+    return (cycles * (size // len(cycles) + 1))[:max(Packet.SIZE_96, size - size % Packet.SIZE_96)]
+
+# each benchmark builds its input for a size and returns a function to run it,
+# with the number of bytes and number of objects it processes on each run
+
+def bench_crc(size):
+    data = _body(size)
+    return lambda: calculate_crc(data), size, 1
+
+def bench_datagroup_tobytes(size):
+    datagroups = _datagroups(size)
+    return lambda: [datagroup.tobytes() for datagroup in datagroups], size, len(datagroups)
+
+def bench_datagroup_frombits(size):
+    datagroups = _datagroups(size)
+    bits = bitarray()
+    bits.frombytes(b''.join(datagroup.tobytes() for datagroup in datagroups))
+    lengths = [7 + len(datagroup.get_data()) + 2 for datagroup in datagroups]
+    def run():
+        i = 0
+        for length in lengths:
+            Datagroup.frombits(bits, i)
+            i += length * 8
+    return run, len(bits) // 8, len(datagroups)
+
+def bench_packet_tobytes(size):
+    packets = encode_packets(_datagroups(size))
+    return lambda: [packet.tobytes() for packet in packets], sum(packet.size for packet in packets), len(packets)
+
+def bench_packet_frombits(size):
+    packets = encode_packets(_datagroups(size))
+    bits = bitarray()
+    bits.frombytes(b''.join(packet.tobytes() for packet in packets))
+    def run():
+        i = 0
+        for packet in packets:
+            Packet.frombits(bits, i)
+            i += packet.size * 8
+    return run, len(bits) // 8, len(packets)
+
+def _bench_segment(strategy):
+    def bench(size):
+        data = _body(size)
+        return lambda: _segment(data, strategy), size, 1
+    return bench
+
+def bench_encode_headermode(size):
+    objects = _objects(size)
+    return lambda: [d.tobytes() for d in encode_headermode(objects)], sum(len(o.get_body()) for o in objects), len(objects)
+
+def bench_encode_directorymode(size):
+    objects = _objects(size)
+    return lambda: [d.tobytes() for d in encode_directorymode(objects)], sum(len(o.get_body()) for o in objects), len(objects)
+
+def bench_encode_packets(size):
+    datagroups = [datagroup.tobytes() for datagroup in _datagroups(size)]
+    return lambda: encode_packets(datagroups), sum(len(data) for data in datagroups), len(datagroups)
+
+def bench_decode_packets(size):
+    capture = _capture(size)
+    return lambda: sum(1 for _ in decode_packets(capture)), len(capture), len(capture) // Packet.SIZE_96
+
+def bench_decode_datagroups(size):
+    capture = _capture(size)
+    return lambda: sum(1 for _ in decode_datagroups(decode_packets(capture))), len(capture), len(capture) // Packet.SIZE_96
+
+BENCHMARKS = [
+    ('crc', bench_crc),
+    ('datagroup.tobytes', bench_datagroup_tobytes),
+    ('datagroup.frombits', bench_datagroup_frombits),
+    ('packet.tobytes', bench_packet_tobytes),
+    ('packet.frombits', bench_packet_frombits),
+    ('segment.constant', _bench_segment(ConstantSegmentSize())),
+    ('segment.completion_trigger', _bench_segment(CompletionTriggerSegmentingStrategy(64))),
+    ('segment.packet_aligned', _bench_segment(PacketAlignedSegmentingStrategy())),
+    ('encode_headermode', bench_encode_headermode),
+    ('encode_directorymode', bench_encode_directorymode),
+    ('encode_packets', bench_encode_packets),
+    ('decode_packets', bench_decode_packets),
+    ('decode_datagroups', bench_decode_datagroups),
+]
+
+def measure(benchmark, size, repeat, min_time):
+    """best time of a run of the benchmark at the given size, as (MB/s, objects/s)"""
+    run, nbytes, nobjects = benchmark(size)
+    best = None
+    for _ in range(repeat):
+        number = 0
+        start = time.perf_counter()
+        while True:
+            run()
+            number += 1
+            elapsed = time.perf_counter() - start
+            if elapsed >= min_time: break
+        t = elapsed / number
+        if best is None or t < best: best = t
+    return nbytes / best / 1e6, nobjects / best
+
+parser = argparse.ArgumentParser(description='Benchmark the encode and decode hot paths against stored baselines')
+parser.add_argument('-s', dest='sizes', nargs='+', default=['1K', '1M', '10M'], help='input sizes, such as 1K 1M 100M')
+parser.add_argument('-k', dest='filter', help='only run benchmarks whose name contains this')
+parser.add_argument('-r', dest='repeat', type=int, default=3, help='number of repeats to take the best of')
+parser.add_argument('-t', dest='min_time', type=float, default=0.2, help='minimum seconds to run each repeat for')
+parser.add_argument('-b', dest='baseline', default=BASELINE, help='baseline file, default: %(default)s')
+parser.add_argument('--save', action='store_true', help='save the results as the baseline, merged with any existing results')
+parser.add_argument('--tolerance', type=float, default=0.2, help='fraction slower than the baseline to report as a regression')
+args = parser.parse_args()
+
+baseline = {}
+if os.path.exists(args.baseline):
+    with open(args.baseline) as f: baseline = json.load(f)
+
+results = {}
+regressions = []
+print('%-28s %6s %12s %14s %10s' % ('benchmark', 'size', 'MB/s', 'objects/s', 'baseline'))
+for name, benchmark in BENCHMARKS:
+    if args.filter and args.filter not in name: continue
+    for size in [_sizes(s) for s in args.sizes]:
+        key = '%s/%s' % (name, _label(size))
+        mbs, ops = measure(benchmark, size, args.repeat, args.min_time)
+        results[key] = {'MB/s': mbs, 'objects/s': ops}
+        change = ''
+        if key in baseline:
+            ratio = mbs / baseline[key]['MB/s']
+            change = '%+.0f%%' % ((ratio - 1) * 100)
+            if ratio < 1 - args.tolerance:
+                regressions.append(key)
+                change += ' !'
+        print('%-28s %6s %12.2f %14.1f %10s' % (name, _label(size), mbs, ops, change))
+        sys.stdout.flush()
+
+if args.save:
+    baseline.update(results)
+    with open(args.baseline, 'w') as f: json.dump(baseline, f, indent=2, sort_keys=True)
+    print('saved %d results to %s' % (len(results), args.baseline))
+elif regressions:
+    print('%d regressions more than %d%% slower than the baseline: %s' % (len(regressions), args.tolerance * 100, ', '.join(regressions)))
+    sys.exit(1)
@@ -0,0 +1,35 @@
+#!/usr/bin/env python
+
+"""
+Benchmark of planning completion trigger segments for large bodies, against the
+previous search over every segment size
+"""
+
+from msc.datagroups import CompletionTriggerSegmentingStrategy, MAX_SEGMENT_SIZE
+import argparse
+import timeit
+
+def brute_force(length, target_final_segment_size, maximum_segment_size=MAX_SEGMENT_SIZE):
+    """the previous search, as it was, for comparison"""
+    X = maximum_segment_size
+    Y = target_final_segment_size
+    while Y > 0:
+        while X > 0:
+            if (length - Y + 2) % X == 0:
+                return X, Y
+            X -= 1
+        Y -= 1
+
+parser = argparse.ArgumentParser(description='Benchmark completion trigger segment planning')
+parser.add_argument('-l', dest='length', type=int, default=1 << 20, help='body length in bytes')
+parser.add_argument('-n', dest='number', type=int, default=10, help='number of runs for each target')
+parser.add_argument('-t', dest='targets', type=int, nargs='+', default=[8, 19, 43, 64, 91, 128, 256], help='target final segment sizes')
+args = parser.parse_args()
+
+print('%8s %10s %8s %14s %14s' % ('target', 'segments', 'final', 'plan (us)', 'search (us)'))
+for target in args.targets:
+    strategy = CompletionTriggerSegmentingStrategy(target)
+    plan = strategy.segment_sizes(args.length)
+    planned = timeit.timeit(lambda: CompletionTriggerSegmentingStrategy(target).segment_sizes(args.length), number=args.number) / args.number
+    searched = timeit.timeit(lambda: brute_force(args.length, target), number=args.number) / args.number
+    print('%8d %10d %8d %14.1f %14.1f' % (target, len(plan), plan[-1], planned * 1e6, searched * 1e6))
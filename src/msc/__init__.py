@@ -43,6 +43,100 @@ class InvalidCrcError(Exception):
         self.crc = crc
         self.data = data
 
+def _is_buffer(data):
+    """whether an object supports the buffer protocol"""
+    try:
+        with memoryview(data): return True
+    except TypeError:
+        return False
+
+class BufferedDecoder:
+    """
+    Base for stateful decoders that are fed with chunks of a bitstream as they
+    arrive, and iterated over for whatever can be decoded from them so far.
+
+    The bitstream is held in a buffer with read and write offsets, so consuming
+    from it only advances the read offset. The unread remainder is moved to the
+    front of the buffer when there is no room left to write, and the buffer only
+    grows when the unread data itself outgrows it.
+    """
+
+    def __init__(self, read_size=1024, buffer_size=65536):
+        """
+        read_size: number of bytes to read at a time when decoding from a file or socket
+        buffer_size: initial size of the buffer in bytes
+        """
+        self.read_size = read_size
+        self._buf = bytearray(buffer_size)
+        self._start = 0 # read offset
+        self._end = 0 # write offset
+        self._discarded = 0 # bytes of bitstream moved out of the front of the buffer
+        self._closed = False
+        self._mapped = False # decoding straight from a buffer holding the whole bitstream
+
+    def __len__(self):
+        """number of bytes buffered and not yet decoded"""
+        return self._end - self._start
+
+    def tell(self):
+        """offset in the bitstream of the next byte to decode"""
+        return self._discarded + self._start
+
+    def map(self, data):
+        """
+        Decode from a buffer holding the whole bitstream, such as an mmap or any other
+        object supporting the buffer protocol, without reading or copying it. Anything
+        decoded holds views into the buffer, so it cannot be closed or resized while
+        they are still in use.
+        """
+        if self._end > self._start: raise ValueError('cannot map a buffer once data has been fed')
+        self._buf = memoryview(data).cast('B')
+        self._start = 0
+        self._end = len(self._buf)
+        self._mapped = True
+        self.close()
+
+    def feed(self, data):
+        """Add a chunk of bitstream to the buffer"""
+        if self._mapped: raise ValueError('cannot feed a decoder mapped onto a buffer')
+        n = len(data)
+        if self._end + n > len(self._buf):
+            remaining = self._end - self._start
+            if remaining + n > len(self._buf):
+                buf = bytearray(max(remaining + n, len(self._buf) * 2))
+                buf[:remaining] = self._buf[self._start:self._end]
+                self._buf = buf
+            else:
+                self._buf[:remaining] = self._buf[self._start:self._end]
+            self._discarded += self._start
+            self._start = 0
+            self._end = remaining
+        self._buf[self._end:self._end + n] = data
+        self._end += n
+
+    def close(self):
+        """Signal the end of the bitstream"""
+        self._closed = True
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        raise NotImplementedError('decoder has not been implemented properly - expected method: __next__(self)')
+
+    def decode(self, data):
+        """Generator function to decode from a file object or socket until it is exhausted"""
+        read = data.read if hasattr(data, 'read') else data.recv
+        r = read(self.read_size)
+        while len(r):
+            self.feed(r)
+            for x in self:
+                yield x
+            r = read(self.read_size)
+        self.close()
+        for x in self:
+            yield x
+
 class TransportIdGenerator():
     '''interface for classes to generate transport IDs'''
 
@@ -0,0 +1,195 @@
+from msc.datagroups import encode_directorymode, encode_headermode, HEADER, DIRECTORY_UNCOMPRESSED, DIRECTORY_COMPRESSED
+from msc.packets import Packet, _required_size
+import bisect
+import collections
+import logging
+import random
+
+logger = logging.getLogger('msc.acquisition')
+
+DIRECTORY = 'directory'
+
+class AcquisitionSimulator:
+    """
+    Works out the time taken for a receiver tuning in at a random moment to acquire
+    the directory and each object of a carousel, being one cycle of datagroups
+    repeated, carried in packets at the given bitrate.
+
+    A receiver is taken to keep every segment it receives whole, in any order, so
+    an object is acquired once each segment of its body has been received along
+    with the directory (directory mode) or its header (header mode). A datagroup
+    already being transmitted when the receiver tunes in is missed.
+
+    The packets and timing are derived from the datagroup sizes, as they would be
+    chunked by encode_packets, without encoding them.
+    """
+
+    def __init__(self, datagroups, bitrate, packet_size=Packet.SIZE_96):
+        if bitrate <= 0: raise ValueError('bitrate must be greater than zero')
+        self.bitrate = bitrate
+        self.packet_size = packet_size
+
+        # transmission of each datagroup in the cycle as (start, end, segment, packets)
+        self.transmissions = []
+        empty = set() # segments carrying no data, as used for padding
+        t = 0.0
+        chunk_size = packet_size - 5
+        for datagroup in datagroups:
+            length = 7 + len(datagroup.get_data()) + 2
+            full, remainder = divmod(length, chunk_size)
+            packets = full + (1 if remainder else 0)
+            size = full * packet_size + (_required_size(remainder, packet_size) if remainder else 0)
+            duration = size * 8.0 / bitrate
+            segment = (datagroup.get_transport_id(), datagroup.get_type(), datagroup.segment_index)
+            if len(datagroup.get_data()) <= 2: empty.add(segment)
+            self.transmissions.append((t, t + duration, segment, packets))
+            t += duration
+        self.cycle_time = t
+        if not self.transmissions: raise ValueError('no datagroups to transmit')
+
+        # segments needed for the directory and for each object
+        groups = {}
+        for start, end, segment, packets in self.transmissions:
+            transport_id, type, index = segment
+            if type in (DIRECTORY_UNCOMPRESSED, DIRECTORY_COMPRESSED): groups.setdefault(DIRECTORY, set()).add(segment)
+            else: groups.setdefault(transport_id, set()).add(segment)
+        self.groups = dict((key, segments) for key, segments in groups.items() if not segments <= empty) # not padding
+        header_mode = any(segment[1] == HEADER for segments in self.groups.values() for segment in segments)
+        self.requirements = {}
+        for key in self.groups:
+            self.requirements[key] = [key] if key == DIRECTORY or header_mode or DIRECTORY not in self.groups else [key, DIRECTORY]
+        logger.debug('simulating acquisition from a cycle of %d datagroups over %.1fs', len(self.transmissions), self.cycle_time)
+
+    def analyse(self):
+        """
+        Returns the expected and worst case acquisition times of the directory and
+        of each object, keyed on transport ID, as (expected, worst) in seconds,
+        without any packet loss
+
+        Between one transmission starting and the next, the next transmission of
+        every segment is fixed, so the acquisition time falls linearly with the
+        moment of tuning in and can be integrated exactly. A requirement is only
+        integrated where the latest transmission it needs changes, so the cost grows
+        with the number of transmissions rather than with that times the objects.
+        """
+        K = len(self.transmissions)
+        T = self.cycle_time
+        group_of = {}
+        for key, segments in self.groups.items():
+            for segment in segments: group_of[segment] = key
+        dependents = dict((key, []) for key in self.groups) # requirements on each group, with the other group needed if any
+        for key, requirement in self.requirements.items():
+            for k in requirement:
+                others = [other for other in requirement if other != k]
+                dependents[k].append((key, others[0] if others else None))
+
+        # the end of the next transmission of each segment after the cycle, being its
+        # first in the next cycle, with the segments of each group ordered latest first
+        next_end = {}
+        for start, end, segment, packets in reversed(self.transmissions):
+            if segment in group_of: next_end[segment] = end + T
+        order = {}
+        group_max = {}
+        for key, segments in self.groups.items():
+            order[key] = collections.OrderedDict((segment, None) for segment in sorted(segments, key=next_end.get, reverse=True))
+            group_max[key] = next_end[next(iter(order[key]))]
+
+        # sweeping backwards over the cycle, the acquisition time only changes slope where
+        # the latest next transmission needed changes, so each requirement is integrated
+        # over runs of transmissions at once, from the start of the latest in the run
+        last = self.transmissions[K - 1][0]
+        M = dict((key, max(group_max[k] for k in requirement)) for key, requirement in self.requirements.items())
+        upper = dict((key, last) for key in self.groups)
+        integrals = dict((key, 0.0) for key in self.groups)
+        worst = dict((key, 0.0) for key in self.groups)
+        for j in range(K - 1, -1, -1):
+            start, end, segment, packets = self.transmissions[j]
+            key = group_of.get(segment)
+            if key is None: continue
+            # the segment transmitted here now has the earliest next transmission of its group,
+            # so the latest is that of the segment transmitted longest before
+            next_end[segment] = end
+            segments = order[key]
+            segments.move_to_end(segment)
+            latest = next_end[next(iter(segments))]
+            if latest == group_max[key]: continue
+            group_max[key] = latest
+
+            # tuning in after this transmission starts falls in the runs ending here
+            for dependent, other in dependents[key]:
+                m = group_max[key]
+                if other is not None and group_max[other] > m: m = group_max[other]
+                previous_m = M[dependent]
+                if m == previous_m: continue
+                if upper[dependent] > start:
+                    integrals[dependent] += previous_m * (upper[dependent] - start)
+                    if previous_m - start > worst[dependent]: worst[dependent] = previous_m - start
+                    upper[dependent] = start
+                M[dependent] = m
+
+        # the last runs, back to tuning in just after the last transmission of the cycle before
+        previous = last - T
+        for key in self.groups:
+            integrals[key] += M[key] * (upper[key] - previous) - (last * last - previous * previous) / 2.0
+            worst[key] = max(worst[key], M[key] - previous)
+
+        return dict((key, (integrals[key] / T, worst[key])) for key in self.groups)
+
+    def simulate(self, loss=0.0, trials=1000, seed=None):
+        """
+        Returns the mean and worst acquisition times found of the directory and of
+        each object, as for analyse, by simulating receivers tuning in at random with
+        each packet lost with the given probability
+        """
+        if not 0 <= loss < 1: raise ValueError('packet loss must be at least zero and less than one')
+        rng = random.Random(seed)
+        K = len(self.transmissions)
+        T = self.cycle_time
+        starts = [start for start, end, segment, packets in self.transmissions]
+        received = [(1 - loss) ** packets for start, end, segment, packets in self.transmissions]
+        group_of = {}
+        for key, segments in self.groups.items():
+            for segment in segments: group_of[segment] = key
+
+        totals = dict((key, 0.0) for key in self.groups)
+        worst = dict((key, 0.0) for key in self.groups)
+        for trial in range(trials):
+            u = rng.random() * T
+            j = bisect.bisect_left(starts, u)
+            remaining = dict((key, set(segments)) for key, segments in self.groups.items())
+            completed = {}
+            while len(completed) < len(self.groups):
+                start, end, segment, packets = self.transmissions[j % K]
+                key = group_of.get(segment)
+                if key in remaining and segment in remaining[key] and (loss == 0 or rng.random() < received[j % K]):
+                    remaining[key].discard(segment)
+                    if not remaining[key]:
+                        completed[key] = end + T * (j // K) - u
+                        del remaining[key]
+                j += 1
+            for key, requirement in self.requirements.items():
+                t = max(completed[k] for k in requirement)
+                totals[key] += t
+                worst[key] = max(worst[key], t)
+
+        return dict((key, (totals[key] / trials, worst[key])) for key in self.groups)
+
+def acquisition_times(objects, bitrate, directory=True, segmenting_strategy=None, packet_size=Packet.SIZE_96, loss=0.0, trials=1000, seed=None):
+    """
+    Returns the expected and worst case acquisition times of the directory and of each
+    object for a carousel of the objects, as (expected, worst) in seconds keyed on
+    transport ID, and on 'directory' for the directory
+
+    With no packet loss the times are calculated exactly, otherwise by simulating
+    the given number of receivers. The directory and padding are given a transport
+    ID that none of the objects use, rather than taking new ones from the transport
+    ID generator for each carousel simulated.
+    """
+    if directory:
+        transport_ids = set(object.get_transport_id() for object in objects)
+        transport_id = next(i for i in range(1 << 16) if i not in transport_ids)
+        datagroups = encode_directorymode(objects, segmenting_strategy=segmenting_strategy, transport_id=transport_id)
+    else: datagroups = encode_headermode(objects, segmenting_strategy=segmenting_strategy)
+    simulator = AcquisitionSimulator(datagroups, bitrate, packet_size)
+    if loss: return simulator.simulate(loss, trials, seed)
+    return simulator.analyse()
@@ -0,0 +1,105 @@
+from msc import _is_buffer
+from msc.datagroups import Datagroup
+from msc.packets import Packet
+from msc.transports import BufferedFileTransport
+import logging
+import mmap
+import struct
+
+logger = logging.getLogger('msc.capture')
+
+# capture file header: magic, version and the bitrate the capture was rendered at
+MAGIC = b'MSCC'
+VERSION = 1
+_FILE_HEADER = struct.Struct('>4sBI')
+
+# record header: timestamp in microseconds of output time, record type and length
+DATAGROUP = 1
+PACKET = 2
+_RECORD = struct.Struct('>QBH')
+
+class CaptureRenderer(BufferedFileTransport):
+    """
+    Renders a datagroup or packet source to a timestamped capture file, simulating
+    air-time without sleeping
+
+    Datagroups and packets are paced with the same model as the transports, so
+    each datagroup takes the time to send it at the bitrate and each packet a
+    24ms slot, and each record is stamped with the output time it starts at. A
+    day of output can then be rendered as fast as it can be encoded, and read back
+    with read_capture.
+    """
+
+    def __init__(self, f, bitrate=16384, block_size=65536, background=False, rotate_size=None, rotate_time=None, logger=logger, metrics=None):
+        BufferedFileTransport.__init__(self, f, bitrate=bitrate, block_size=block_size, background=background, rotate_size=rotate_size, rotate_time=rotate_time, logger=logger, metrics=metrics)
+        self.records = 0
+        self._header()
+
+    def _header(self):
+        header = _FILE_HEADER.pack(MAGIC, VERSION, self.bitrate)
+        self.buf += header
+        self.bytes_written += len(header)
+        self.file_bytes += len(header)
+
+    def add(self, d):
+        if isinstance(d, Datagroup):
+            b = d.tobytes()
+            kind, t = DATAGROUP, 8 * float(len(b)) / self.bitrate
+        elif isinstance(d, Packet):
+            b = d.tobytes()
+            kind, t = PACKET, 0.024
+        else: raise TypeError('neither a datagroup nor packet: %s' % type(d))
+        self.write(_RECORD.pack(int(round(self.output_time * 1e6)), kind, len(b)) + b, t)
+        self.records += 1
+
+    def rotate(self):
+        BufferedFileTransport.rotate(self)
+        self._header()
+
+    def render(self, source, duration=None):
+        """
+        Render the given number of seconds of output time from a source, as fast as it
+        can be encoded, returning the number of records written
+
+        The source may be a callback as for the transports, or an iterable of datagroups
+        and packets which is rendered until it is exhausted if no duration is given.
+        """
+        if not callable(source):
+            items = iter(source)
+            def callback():
+                for d in items: return d
+                self.stop()
+            source = callback
+        logger.debug('rendering %s seconds of output to capture: %s', duration, self.path)
+        self.start(source, duration)
+        return self.records
+
+def read_capture(data):
+    """
+    Generator function yielding (timestamp, type, data) for each record of a capture,
+    with the timestamp in seconds of output time
+
+    The capture may be presented as a file object, which is memory mapped where
+    possible, or a buffer such as an mmap. The data of each record is a view into
+    the capture.
+    """
+
+    if not _is_buffer(data):
+        try:
+            data = mmap.mmap(data.fileno(), 0, access=mmap.ACCESS_READ)
+        except (AttributeError, OSError, ValueError):
+            data = data.read()
+    view = memoryview(data).cast('B')
+
+    magic, version, bitrate = _FILE_HEADER.unpack_from(view, 0)
+    if magic != MAGIC: raise ValueError('not a capture file')
+    if version != VERSION: raise ValueError('unsupported capture version: %d' % version)
+    logger.debug('reading capture rendered at %d bps', bitrate)
+
+    i = _FILE_HEADER.size
+    while i + _RECORD.size <= len(view):
+        timestamp, kind, length = _RECORD.unpack_from(view, i)
+        i += _RECORD.size
+        if i + length > len(view): raise ValueError('capture is truncated')
+        yield timestamp / 1e6, kind, view[i:i+length]
+        i += length
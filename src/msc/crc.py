@@ -0,0 +1,95 @@
+from msc import crcfun
+import logging
+
+try:
+    import numpy
+except ImportError: # only needed for vectorized verification
+    numpy = None
+
+logger = logging.getLogger('msc.crc')
+
+# CRC-16 as used for MSC packets and datagroups: G(x) = x^16 + x^12 + x^5 + 1,
+# register preset to all ones and the result inverted
+POLYNOMIAL = 0x1021
+PRESET = 0xFFFF
+
+def _build_table():
+    table = []
+    for i in range(256):
+        crc = i << 8
+        for _ in range(8):
+            crc = ((crc << 1) ^ POLYNOMIAL) if crc & 0x8000 else (crc << 1)
+        table.append(crc & 0xFFFF)
+    return table
+
+# byte-wise lookup table for the polynomial
+TABLE = _build_table()
+
+class Crc:
+    """Incremental CRC state, so that a CRC can be accumulated over data
+       as it arrives rather than recalculated over the joined buffer"""
+
+    def __init__(self, data=None):
+        self.reset()
+        if data is not None: self.update(data)
+
+    def reset(self):
+        self.value = crcfun(b'')
+
+    def update(self, data):
+        """Accumulate a bytes-like object into the CRC, returning the state"""
+        self.value = crcfun(data, self.value)
+        return self
+
+    def copy(self):
+        crc = Crc()
+        crc.value = self.value
+        return crc
+
+    def __eq__(self, other):
+        if isinstance(other, Crc): return self.value == other.value
+        return self.value == other
+
+    def __repr__(self):
+        return '<Crc: 0x%04x>' % self.value
+
+def verify_packets(data, size=96):
+    """
+    Verify the CRCs of a run of fixed-size packets in a single call, returning
+    a list of booleans flagging the packets with a valid CRC.
+
+    The packets may be presented as any bytes-like object, or as a 2-dimensional
+    NumPy array of N packets by `size` bytes. Trailing bytes that do not make up
+    a whole packet are ignored.
+
+    Where NumPy is available the CRCs are calculated for all packets at once,
+    otherwise packet by packet.
+    """
+
+    if numpy is None:
+        view = memoryview(data).cast('B') if not isinstance(data, memoryview) else data
+        mask = []
+        for i in range(0, len(view) - size + 1, size):
+            crc = (view[i + size - 2] << 8) | view[i + size - 1]
+            mask.append(crcfun(view[i : i + size - 2]) == crc)
+        return mask
+
+    if isinstance(data, numpy.ndarray) and data.ndim == 2:
+        packets = data
+        size = packets.shape[1]
+    else:
+        buf = numpy.frombuffer(data, dtype=numpy.uint8)
+        packets = buf[:len(buf) - len(buf) % size].reshape(-1, size)
+    logger.debug('verifying CRCs of %d packets of %d bytes', len(packets), size)
+
+    # run the table over each byte column of all packets together, with the
+    # columns made contiguous first
+    columns = numpy.ascontiguousarray(packets.T)
+    table = numpy.array(TABLE, dtype=numpy.uint16)
+    crc = numpy.full(len(packets), PRESET, dtype=numpy.uint16)
+    for column in columns[:size - 2]:
+        crc = (crc << 8) ^ table[(crc >> 8) ^ column]
+    crc ^= 0xFFFF
+
+    signalled = (columns[size - 2].astype(numpy.uint16) << 8) | columns[size - 1]
+    return (crc == signalled).tolist()
@@ -1,9 +1,15 @@
-from msc import bitarray_to_hex, int_to_bitarray, calculate_crc, InvalidCrcError, generate_transport_id
+from msc import bitarray_to_hex, int_to_bitarray, calculate_crc, InvalidCrcError, generate_transport_id, BufferedDecoder, _is_buffer
+from msc.crc import Crc
+from msc.metrics import get_metrics
+from msc.packets import Packet, iter_packets, _required_size
 from mot import DirectoryEncoder, SortedHeaderInformation
 from bitarray import bitarray
 import logging
+import struct
 import types
+import copy
 import itertools
+import math
 
 logger = logging.getLogger('msc.datagroups')
 
@@ -15,6 +21,11 @@ BODY = 4
 DIRECTORY_UNCOMPRESSED = 6
 DIRECTORY_COMPRESSED = 7  
 
+# packed datagroup header, segment field and user access field (7 bytes)
+_HEADER = struct.Struct('>BBHBH')
+_CRC = struct.Struct('>H')
+_SEGMENT_HEADER = struct.Struct('>H') # segment repetition count and size
+
 class SegmentingStrategy:
     
     def get_next_segment_size(self, data, position, segments):
@@ -38,6 +49,7 @@ class CompletionTriggerSegmentingStrategy(SegmentingStrategy):
        
     def __init__(self, target_final_segment_size, maximum_segment_size=MAX_SEGMENT_SIZE, ):
         if target_final_segment_size > maximum_segment_size: raise ValueError('target final segment size must be less than the maximum segment size')
+        if target_final_segment_size < 1: raise ValueError('target final segment size must be at least one byte')
         self.maximum_segment_size = maximum_segment_size
         
 #        # calculate the estimated final segment size from parameters
@@ -47,35 +59,147 @@ class CompletionTriggerSegmentingStrategy(SegmentingStrategy):
 #        estimated_final_segment_size -= 2 # datagroup CRC
 #        estimated_final_segment_size -= 7 # datagroup header (typical minimal config)
         self.target_final_segment_size = target_final_segment_size
-        
+        self._plans = {}
+
     def calculate_segment_sizes(self, length):
-        
-        # need to try for the exact target final segment size, or less
-        # with equal sizes of the preceding segments - therefore they
-        # will need to be exactly fitting
+        """Returns the size of the preceding segments and the size of the final segment"""
+        plan = self.segment_sizes(length)
+        return plan[0], plan[-1]
+
+    def segment_sizes(self, length):
+        """
+        Returns the list of segment sizes for data of the given length, being equal
+        sized segments followed by a final segment of the target size or less
+
+        The fewest segments are used, and for that number the largest final segment.
+        Where that would need the preceding segments to be less than half the maximum
+        size, they are the maximum size instead, with the remainder split so that the
+        final segment is the target size. Plans are cached by length.
+        """
+        plan = self._plans.get(length)
+        if plan is not None: return plan
+
         X = self.maximum_segment_size
         Y = self.target_final_segment_size
-        while Y > 0:
-            while X > 0:
-                if (length - Y + 2) % X == 0:
-                    return X, Y
-                X -= 1
-            Y -= 1
-            
-    def get_next_segment_size(self, data, position, segments):            
-            
-        if not len(segments): # no calculation done yet
-            X, Y = self.calculate_segment_sizes(len(data))
-        else: 
-            X = len(segments[0]) - 2
-            n = 1
-            Y = (len(data) / X) % n - 2
-            while Y > self.target_final_segment_size:
-                n += 1
-                
-        if len(data) - position > Y: return X
-        else: return Y
-                
+        if length <= Y:
+            plan = [length]
+        else:
+            # k preceding segments of equal size leave a final segment congruent to the
+            # length modulo k, which fits for any k up to Y, but for larger k only where
+            # the length modulo k happens to be small enough, so the search is bounded
+            # to keep the preceding segments at least half the maximum size
+            least = max(1, (length - Y + X - 1) // X)
+            plan = None
+            for k in range(least, max(least, 2 * (length - Y) // X) + 1):
+                final = (length - 1) % k + 1
+                if final > Y: continue
+                final += k * ((Y - final) // k)
+                if (length - final) // k <= X:
+                    plan = [(length - final) // k] * k + [final]
+                    break
+            if plan is None:
+                full, remainder = divmod(length - Y, X)
+                plan = [X] * full + ([remainder] if remainder else []) + [Y]
+
+        logger.debug('segmenting %d bytes into %d segments with a final segment of %d bytes', length, len(plan), plan[-1])
+        self._plans[length] = plan
+        return plan
+
+    def get_next_segment_size(self, data, position, segments):
+        return self.segment_sizes(len(data))[len(segments)]
+
+class PacketAlignedSegmentingStrategy(SegmentingStrategy):
+    """Strategy to size segments so that each datagroup fills a whole number of packet
+       payloads, leaving only the final datagroup of an object to be padded"""
+
+    def __init__(self, packet_size=Packet.SIZE_96, maximum_segment_size=MAX_SEGMENT_SIZE):
+        if packet_size not in Packet.sizes: raise ValueError('packet size %d must be one of: %s' % (packet_size, Packet.sizes))
+        self.packet_size = packet_size
+        self.maximum_segment_size = maximum_segment_size
+
+        # datagroup header, segment header and CRC around each segment
+        payload_size = packet_size - 5
+        self.segment_size = ((maximum_segment_size + 11) // payload_size) * payload_size - 11
+        if self.segment_size < 1: raise ValueError('maximum segment size is too small to fill a packet')
+
+    def get_next_segment_size(self, data, position, segments):
+        return self.segment_size
+
+    def report(self, objects, baseline=None):
+        """
+        Returns the bytes of packet padding for the body of each object, as a list of
+        (transport ID, padding, bytes saved) against a baseline strategy, by default
+        segments of the maximum size
+        """
+        if baseline is None: baseline = ConstantSegmentSize(self.maximum_segment_size)
+        report = []
+        for object in objects:
+            padding = segment_padding(_segment(object.get_body(), self), self.packet_size)
+            saved = segment_padding(_segment(object.get_body(), baseline), self.packet_size) - padding
+            logger.debug('object %d has %d bytes of packet padding, saving %d bytes', object.get_transport_id(), padding, saved)
+            report.append((object.get_transport_id(), padding, saved))
+        return report
+
+def segment_padding(segments, packet_size=Packet.SIZE_96):
+    """Returns the bytes of padding in the packets carrying datagroups of the given segments"""
+    payload_size = packet_size - 5
+    padding = 0
+    for segment in segments:
+        length = 7 + len(segment) + 2
+        full, remainder = divmod(length, payload_size)
+        if remainder: padding += _required_size(remainder, packet_size) - 5 - remainder
+    return padding
+
+class Segment:
+    """
+    A segment of data along with its 2-byte segment header, holding a view over the
+    data so that it is not copied until the datagroup carrying it is encoded
+    """
+
+    def __init__(self, data, offset=0, length=None, repetition=0):
+        view = data if isinstance(data, memoryview) else memoryview(data)
+        if length is None: length = len(view) - offset
+        self.offset = offset
+        self.view = view[offset:offset+length]
+        self.header = _SEGMENT_HEADER.pack(((repetition & 0x07) << 13) | (len(self.view) & 0x1fff))
+
+    def __len__(self):
+        return 2 + len(self.view)
+
+    def write_into(self, buf, offset=0):
+        """write the segment header and data into a buffer at the given offset"""
+        buf[offset:offset+2] = self.header
+        buf[offset+2:offset+2+len(self.view)] = self.view
+
+    def tobytes(self):
+        return self.header + self.view.tobytes()
+
+    def __bytes__(self):
+        return self.tobytes()
+
+    def __getitem__(self, key):
+        # indexing the header or the view, so that only a slice of the data is copied
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+            if step == 1 and start >= 2: return self.view[start-2:max(start, stop)-2].tobytes()
+            return self.tobytes()[key]
+        if key < 0: key += len(self)
+        if not 0 <= key < len(self): raise IndexError('segment index out of range')
+        return self.header[key] if key < 2 else self.view[key-2]
+
+    def __eq__(self, other):
+        if isinstance(other, Segment): return self.header == other.header and self.view == other.view
+        try: other = memoryview(other)
+        except TypeError: return NotImplemented
+        return len(other) == len(self) and other[:2] == self.header and other[2:] == self.view
+
+    def __hash__(self):
+        # equal to the bytes of the segment, so hashes the same
+        return hash(self.tobytes())
+
+    def __repr__(self):
+        return '<Segment: offset=%d, size=%d bytes>' % (self.offset, len(self.view))
+
 def _segment(data, strategy):
 
     segments = []
@@ -83,95 +207,101 @@ def _segment(data, strategy):
     # partition the segments up using the maximum segment size
     i = 0
     if not data: return segments
+    view = memoryview(data)
     while i < len(data):
         segment_size = strategy.get_next_segment_size(data, i, segments)
-        
-        # get segment data
-        segment_data = data[i:i+segment_size if i+segment_size < len(data) else len(data)]
-                
-        # segment header
-        bits = bitarray()
-        bits += int_to_bitarray(0, 3) # (0-2): Repetition Count remaining (0 = only broadcast)
-        bits += int_to_bitarray(len(segment_data), 13) # (3-16): SegmentSize
-
-        segments.append((bits.tobytes()) + segment_data)
-        
+        segments.append(Segment(view, i, min(segment_size, len(data) - i)))
         i += segment_size
 
     return segments;    
 
-def encode_headermode(objects, segmenting_strategy=None):
+def _headermode_datagroups(object, segmenting_strategy):
+    """Header and body datagroups for an object in header mode"""
+
+    datagroups = []
+
+    # split body data into segments
+    body_data = object.get_body()
+    body_segments = _segment(body_data, segmenting_strategy)
+
+    # encode header extension parameters
+    extension_bits = bitarray()
+    for parameter in object.get_parameters():
+        extension_bits += parameter.encode()
+    
+    # insert the core parameters into the header    
+    bits = bitarray()
+    bits += int_to_bitarray(len(body_data) if body_data else 0, 28) # (0-27): BodySize in bytes
+    bits += int_to_bitarray(len(extension_bits) / 8 + 7, 13) # (28-40): HeaderSize in bytes (core=7 + extension)
+    bits += int_to_bitarray(object.get_type().type, 6)  # (41-46): ContentType 
+    bits += int_to_bitarray(object.get_type().subtype, 9) # (47-55): ContentSubType
+    bits += extension_bits # (56-n): Header extension data
+    header_segments = _segment(bits.tobytes(), segmenting_strategy)
+
+    # add header datagroups
+    for i, segment in enumerate(header_segments):
+        header_group = Datagroup(object.get_transport_id(), HEADER, segment, i, i%16, last=True if i == len(header_segments) - 1 else False)
+        datagroups.append(header_group)
+    
+    # add body datagroups
+    for i, segment in enumerate(body_segments):
+        body_group = Datagroup(object.get_transport_id(), BODY, segment, i, i%16, last=True if i == len(body_segments) - 1 else False)
+        datagroups.append(body_group)
+
+    return datagroups
+
+def encode_headermode(objects, segmenting_strategy=None, workers=None):
     """
     Encode a set of MOT Objects into header mode segments
+
+    workers: number of processes to encode the objects across, or None to encode them
+             in this process
     """
 
-    datagroups = []
     if not segmenting_strategy: segmenting_strategy=ConstantSegmentSize()
     
     # backward compatibility
     if not isinstance(objects, list): objects = [objects] 
     logger.debug('encoding %d MOT objects to header mode datagroups', len(objects))
 
-    for object in objects:   
+    for object in objects:
         if not object: raise ValueError('object returned is null')
 
-        # split body data into segments
-        body_data = object.get_body()
-        body_segments = _segment(body_data, segmenting_strategy)
-    
-        # encode header extension parameters
-        extension_bits = bitarray()
-        for parameter in object.get_parameters():
-            extension_bits += parameter.encode()
-        
-        # insert the core parameters into the header    
-        bits = bitarray()
-        bits += int_to_bitarray(len(body_data) if body_data else 0, 28) # (0-27): BodySize in bytes
-        bits += int_to_bitarray(len(extension_bits) / 8 + 7, 13) # (28-40): HeaderSize in bytes (core=7 + extension)
-        bits += int_to_bitarray(object.get_type().type, 6)  # (41-46): ContentType 
-        bits += int_to_bitarray(object.get_type().subtype, 9) # (47-55): ContentSubType
-        bits += extension_bits # (56-n): Header extension data
-        header_segments = _segment(bits.tobytes(), segmenting_strategy)
-
-        # add header datagroups
-        for i, segment in enumerate(header_segments):
-            header_group = Datagroup(object.get_transport_id(), HEADER, segment, i, i%16, last=True if i == len(header_segments) - 1 else False)
-            datagroups.append(header_group)
-        
-        # add body datagroups
-        for i, segment in enumerate(body_segments):
-            body_group = Datagroup(object.get_transport_id(), BODY, segment, i, i%16, last=True if i == len(body_segments) - 1 else False)
-            datagroups.append(body_group)
+    if workers:
+        from msc.parallel import ParallelEncoder
+        with ParallelEncoder(workers, segmenting_strategy) as encoder:
+            return encoder.encode_headermode(objects)
+
+    datagroups = []
+    for object in objects:   
+        datagroups.extend(_headermode_datagroups(object, segmenting_strategy))
         
-        return datagroups;
+    return datagroups;
 
 
-def encode_directorymode(objects, directory_parameters=None, segmenting_strategy=None):
-    """
-    Encode a set of MOT objects into directory mode segments, along with a segmented
-    directory object
-    """
+def _encode_directory_entry(object):
+    """Encode the directory entry for an object, being its transport ID and header"""
 
-    datagroups = []
-    if not segmenting_strategy: segmenting_strategy=ConstantSegmentSize()
+    # encode header extension parameters
+    extension_bits = bitarray()
+    for parameter in object.get_parameters():
+        extension_bits += parameter.encode()
+    
+    # transport ID in first 2 bytes
+    bits = bitarray()
+    bits += int_to_bitarray(object.get_transport_id(), 16)
+    
+    # add the core parameters into the header    
+    bits += int_to_bitarray(len(object.get_body()), 28) # (0-27): BodySize in bytes
+    bits += int_to_bitarray(len(extension_bits) / 8 + 7, 13) # (28-40): HeaderSize in bytes (core=7 + extension)
+    bits += int_to_bitarray(object.get_type().type, 6)  # (41-46): ContentType 
+    bits += int_to_bitarray(object.get_type().subtype, 9) # (47-55): ContentSubType
+    bits += extension_bits # (56-n): Header extension data
 
-    # build the directory entries
-    entries = bitarray()
-    for object in objects:              
-        # encode header extension parameters
-        extension_bits = bitarray()
-        for parameter in object.get_parameters():
-            extension_bits += parameter.encode()
-        
-        # transport ID in first 2 bytes
-        entries += int_to_bitarray(object.get_transport_id(), 16)
-        
-        # add the core parameters into the header    
-        entries += int_to_bitarray(len(object.get_body()), 28) # (0-27): BodySize in bytes
-        entries += int_to_bitarray(len(extension_bits) / 8 + 7, 13) # (28-40): HeaderSize in bytes (core=7 + extension)
-        entries += int_to_bitarray(object.get_type().type, 6)  # (41-46): ContentType 
-        entries += int_to_bitarray(object.get_type().subtype, 9) # (47-55): ContentSubType
-        entries += extension_bits # (56-n): Header extension data
+    return bits.tobytes()
+
+def _encode_directory(entries, number_of_objects, directory_parameters=None, carousel_period=0):
+    """Encode a directory object from its encoded entries, with the carousel period in tenths of seconds"""
 
     # build directory parameters
     directory_params = bitarray()
@@ -183,9 +313,9 @@ def encode_directorymode(objects, directory_parameters=None, segmenting_strategy
     bits = bitarray()
     bits += bitarray('0') # (0): CompressionFlag: This bit shall be set to 0
     bits += bitarray('0') # (1): RFU
-    bits += int_to_bitarray(len(entries.tobytes()) + 13 + len(directory_params.tobytes()), 30) # (2-31): DirectorySize: total size of the MOT directory in bytes, including the 13 header bytes and length of the directory parameter bytes
-    bits += int_to_bitarray(len(objects), 16) # (32-47): NumberOfObjects: Total number of objects described by the directory
-    bits += int_to_bitarray(0, 24) # (48-71): DataCarouselPeriod: Max time in tenths of seconds for the data carousel to complete a cycle. Value of zero for undefined
+    bits += int_to_bitarray(len(entries) + 13 + len(directory_params.tobytes()), 30) # (2-31): DirectorySize: total size of the MOT directory in bytes, including the 13 header bytes and length of the directory parameter bytes
+    bits += int_to_bitarray(number_of_objects, 16) # (32-47): NumberOfObjects: Total number of objects described by the directory
+    bits += int_to_bitarray(min(carousel_period, 0xFFFFFF), 24) # (48-71): DataCarouselPeriod: Max time in tenths of seconds for the data carousel to complete a cycle. Value of zero for undefined
     bits += bitarray('000') # (72-74): RFU
     bits += int_to_bitarray(0, 13) # (75-87): SegmentSize: Size in bytes that will be used for the segmentation of objects within the MOT carousel. Value of zero indicates that objects can have different segmentation sizes. The last segment of an obect may be smaller than this size.
     bits += int_to_bitarray(len(directory_params.tobytes()), 16) # (88-103): DirectoryExtensionLength: Length of following directory extension bytes
@@ -194,42 +324,92 @@ def encode_directorymode(objects, directory_parameters=None, segmenting_strategy
     bits += directory_params
     
     # add directory entries
-    bits += entries 
-    
-    # segment and add directory datagroups with a new transport ID
+    return bits.tobytes() + entries
+
+def _directory_datagroups(directory, segmenting_strategy, transport_id=None):
+    """Segment a directory object into datagroups, with a new transport ID unless one is given"""
+    datagroups = []
     continuity_directory = 0
-    directory_transport_id = generate_transport_id()
-    segments = _segment(bits.tobytes(), segmenting_strategy)
+    directory_transport_id = transport_id if transport_id is not None else generate_transport_id()
+    segments = _segment(directory, segmenting_strategy)
     for i, segment in enumerate(segments):
         header_group = Datagroup(directory_transport_id, DIRECTORY_UNCOMPRESSED, segment, i, continuity_directory, last=True if i == len(segments) - 1 else False)
-        tmp = bitarray()
-        tmp.frombytes(header_group.tobytes())
-        tmp.frombytes(header_group.tobytes())
         datagroups.append(header_group)
         continuity_directory = (continuity_directory + 1) % 16
-        
-    # add body datagroups
-    continuity_body = 0
-    for object in objects:
-        segments = _segment(object.get_body(), segmenting_strategy)
-        for i, segment in enumerate(segments):
-            body_group = Datagroup(object.get_transport_id(), BODY, segment, i, continuity_body, last=True if i == len(segments) - 1 else False)
-            datagroups.append(body_group)
-            continuity_body = (continuity_body + 1) % 16
-    # add empty body datagroups to assure continuity
+    return datagroups
+
+def _body_datagroups(object, segmenting_strategy):
+    """Segment the body of an object into datagroups, with continuity indices to be set"""
+    datagroups = []
+    segments = _segment(object.get_body(), segmenting_strategy)
+    for i, segment in enumerate(segments):
+        body_group = Datagroup(object.get_transport_id(), BODY, segment, i, 0, last=True if i == len(segments) - 1 else False)
+        datagroups.append(body_group)
+    return datagroups
+
+def _renumbered(datagroup, continuity):
+    """The datagroup with the given continuity index, copied if it has another so that
+       a datagroup already in a carousel is never renumbered"""
+    if datagroup.continuity == continuity: return datagroup
+    datagroup = copy.copy(datagroup)
+    datagroup.continuity = continuity
+    return datagroup
+
+def _continuity_padding(continuity_body, transport_id=None):
+    """Empty body datagroups to assure continuity following the given continuity index,
+       with new transport IDs unless one is given"""
+    datagroups = []
     if continuity_body != 0:
         # segment header
         bits = bitarray()
         bits += int_to_bitarray(0, 3) # (0-2): Repetition Count remaining (0 = only broadcast)
         bits += int_to_bitarray(0, 13) # (3-16): SegmentSize
         dummysegment = bits.tobytes()
-        body_group = Datagroup(generate_transport_id(), BODY, dummysegment, 0, continuity_body, last=True)
+        body_group = Datagroup(transport_id if transport_id is not None else generate_transport_id(), BODY, dummysegment, 0, continuity_body, last=True)
         datagroups.append(body_group)
         continuity_body = (continuity_body + 1) % 16
         if continuity_body != 0:
             continuity_body = 15
-            body_group = Datagroup(generate_transport_id(), BODY, dummysegment, 0, continuity_body, last=True)
+            body_group = Datagroup(transport_id if transport_id is not None else generate_transport_id(), BODY, dummysegment, 0, continuity_body, last=True)
             datagroups.append(body_group)
+    return datagroups
+
+def encode_directorymode(objects, directory_parameters=None, segmenting_strategy=None, carousel_period=0, workers=None, transport_id=None):
+    """
+    Encode a set of MOT objects into directory mode segments, along with a segmented
+    directory object
+
+    carousel_period: maximum time for the carousel to complete a cycle, in tenths of
+                     seconds, to signal in the directory (0 for undefined)
+    workers: number of processes to encode the objects across, or None to encode them
+             in this process
+    transport_id: transport ID for the directory and any padding, rather than taking
+                  new ones from the transport ID generator
+    """
+
+    if not segmenting_strategy: segmenting_strategy=ConstantSegmentSize()
+
+    if workers:
+        from msc.parallel import ParallelEncoder
+        with ParallelEncoder(workers, segmenting_strategy) as encoder:
+            return encoder.encode_directorymode(objects, directory_parameters, carousel_period, transport_id)
+
+    # build the directory entries
+    entries = b''.join([_encode_directory_entry(object) for object in objects])
+    
+    # segment and add directory datagroups with a new transport ID
+    datagroups = _directory_datagroups(_encode_directory(entries, len(objects), directory_parameters, carousel_period), segmenting_strategy, transport_id)
+        
+    # add body datagroups
+    continuity_body = 0
+    for object in objects:
+        for body_group in _body_datagroups(object, segmenting_strategy):
+            body_group.continuity = continuity_body
+            datagroups.append(body_group)
+            continuity_body = (continuity_body + 1) % 16
+
+    # add empty body datagroups to assure continuity
+    datagroups.extend(_continuity_padding(continuity_body, transport_id))
 
     return datagroups
 
@@ -243,81 +423,214 @@ def read(fd, n = 1):
         if f[1] > 0:
             return fd.read(n)
 
-def decode_datagroups(data, error_callback=None, check_crc=True, resync=True):
+class DatagroupFramer(BufferedDecoder):
+    """
+    Stateful datagroup framer, fed with chunks of a datagroup bitstream of any size
+    as they arrive and iterated over for the datagroups that can be framed from them
+    so far.
+
+    The length of each datagroup is found from its header, honouring the extension,
+    segment and user access flags and the user access length indicator, followed
+    by the segment header.
+    """
+
+    def __init__(self, error_callback=None, check_crc=True, resync=True, read_size=65536, buffer_size=None, metrics=None):
+        """
+        error_callback: called with any InvalidCrcError
+        check_crc: check the CRC of each datagroup
+        resync: on a CRC error, resynchronise byte by byte rather than skip the datagroup
+        read_size: number of bytes to read at a time when decoding from a file or socket
+        buffer_size: initial size of the buffer in bytes, by default twice the read size
+        metrics: metrics to count datagroups and errors in, by default the default metrics
+        """
+        BufferedDecoder.__init__(self, read_size=read_size, buffer_size=buffer_size or read_size * 2)
+        self.error_callback = error_callback
+        self.check_crc = check_crc
+        self.resync = resync
+        self.metrics = metrics if metrics is not None else get_metrics()
+        self._resyncing = False
+        self._skipped = 0 # bytes skipped since the last datagroup, counted once one is framed
+
+    def _count_skipped(self):
+        if self._skipped: self.metrics.increment('datagroups.bytes_skipped', self._skipped)
+        self._skipped = 0
+
+    def __next__(self):
+        while self._end - self._start >= 9 + 2:
+            try:
+                datagroup = Datagroup.frombytes(memoryview(self._buf)[:self._end], self._start, check_crc=self.check_crc)
+            except IncompleteDatagroupError:
+                if not (self._closed and self.resync): break
+                # nothing more is coming, so a candidate running past the end cannot be trusted
+                self._resyncing = True
+                self._start += 1
+                self._skipped += 1
+                continue
+            except InvalidCrcError as ice:
+                if not self._resyncing:
+                    self.metrics.increment('datagroups.crc_errors')
+                    if self.error_callback: self.error_callback(ice)
+                self._resyncing = self.resync
+                n = 1 if self.resync else len(ice.data)
+                self._start += n
+                self._skipped += n
+                continue
+            if self._resyncing:
+                # only a datagroup with a valid CRC can be trusted to resynchronise on
+                if not datagroup.crc_enabled:
+                    self._start += 1
+                    self._skipped += 1
+                    continue
+                self._resyncing = False
+            self._count_skipped()
+            if not self._mapped: datagroup._data = datagroup._data.tobytes() # the buffer will be reused
+            self._start += datagroup.size
+            if self.metrics.enabled: self.metrics.increment('datagroups.decoded')
+            return datagroup
+        if self._closed: self._count_skipped()
+        raise StopIteration
+
+def decode_datagroups(data, error_callback=None, check_crc=True, resync=True, read_size=65536, metrics=None):
     """
     Generator function to decode datagroups from a bitstream
 
-    The bitstream may be presented as either a bitarray, a file object or a generator
+    The bitstream may be presented as either a bitarray, a file object, a generator
+    or a buffer such as an mmap, in which case the datagroups hold views into it
     """ 
 
     if isinstance(data, bitarray):
-        i = 0
-        while i < len(data):
-            datagroup = Datagroup.frombits(data, i=i, check_crc=check_crc)
+        framer = DatagroupFramer(error_callback=error_callback, check_crc=check_crc, resync=resync, metrics=metrics)
+        framer.feed(memoryview(data)[:len(data) // 8])
+        framer.close()
+        for datagroup in framer:
+            yield datagroup
+    elif _is_buffer(data):
+        logger.debug('decoding datagroups from buffer: %s', type(data))
+        framer = DatagroupFramer(error_callback=error_callback, check_crc=check_crc, resync=resync, metrics=metrics)
+        framer.map(data)
+        for datagroup in framer:
             yield datagroup
-            i += (datagroup.size * 8)
-    elif isinstance(data, file):
+    elif hasattr(data, 'read'):
         logger.debug('decoding datagroups from file: %s', data)
-        buf = bitarray()
-        reading = True
-        while reading:
-            try:
-                r = data.read(8)
-                buf.frombytes(r)
-            except: 
-                reading = False
-                logger.exception("error")
-            if not len(buf): 
-                logger.debug('buffer is at zero length')
-                return
-            i = 0
-            #logger.debug('chunking buffer of length %d bytes', len(buf)/8)
-            length = len(buf)/8
-            if length < 9: 
-                continue
-            size = int(buf[59:72].to01(), 2)
-            if length < size: 
-                #logger.debug('buffer still not at right size for datagroup size of %d bytes', size)
-                continue
-            while i < len(buf):
-                try:
-                    datagroup = Datagroup.frombits(buf, i=i, check_crc=check_crc)
-                    yield datagroup
-                    i = (datagroup.size * 8)
-                    buf = buf[i:]
-                except IncompleteDatagroupError: 
-                    break
-                except (InvalidCrcError, ice):
-                    if error_callback: error_callback(ice) 
-                    buf = buf[8:] # attempt to resync?
-                    #i += 8
-            
+        framer = DatagroupFramer(error_callback=error_callback, check_crc=check_crc, resync=resync, read_size=read_size, metrics=metrics)
+        for datagroup in framer.decode(data):
+            yield datagroup
     elif isinstance(data, types.GeneratorType):
         logger.debug('decoding datagroups from generator: %s', data)
-        buf = bitarray()
-        
-        i = 0
-        in_packet = False
-        for p in data:
-            if not in_packet and p.first: 
-                in_packet = True
-            elif not in_packet: continue 
-            
-            buf.frombytes(p.data)
-            
-            if p.last:
-                logger.debug('got packet %s -  buffer now %d bytes', p, len(buf)/8)
-                try:
-                    datagroup = Datagroup.frombits(buf, i=i, check_crc=check_crc)
-                    logger.debug('yielding datagroup: %s', datagroup)
-                    yield datagroup                    
-                except (IncompleteDatagroupError, ide): 
-                    if error_callback: error_callback(ide) 
-                except (InvalidCrcError, ice):
-                    if error_callback: error_callback(ice) 
-                del buf
-                buf = bitarray()
-                in_packet = False
+        reassembler = DatagroupReassembler(error_callback=error_callback, check_crc=check_crc, metrics=metrics)
+        for address, datagroup in reassembler.reassemble(data):
+            yield datagroup
+
+class ReassemblyState:
+    """Reassembly buffer, continuity tracking and counters for a single packet address"""
+
+    def __init__(self, address):
+        self.address = address
+        self.index = None # continuity index of the last packet
+        self.buf = None # datagroup being reassembled, None if between datagroups
+        self.crc = Crc()
+        self.crc_fed = 0
+
+        # counters
+        self.packets = 0
+        self.datagroups = 0
+        self.crc_errors = 0
+        self.continuity_errors = 0
+        self.incomplete = 0
+
+    def __str__(self):
+        return 'address=%d, packets=%d, datagroups=%d, crc errors=%d, continuity errors=%d, incomplete=%d' % (self.address, self.packets, self.datagroups, self.crc_errors, self.continuity_errors, self.incomplete)
+
+class DatagroupReassembler:
+    """
+    Reassembles datagroups from packets, keeping an independent buffer, continuity
+    tracking and error counters for each packet address.
+
+    The datagroup CRC is accumulated as each packet arrives, rather than calculated
+    over the whole datagroup once it is complete. Packets for addresses outside of
+    any given whitelist are dropped on their address alone.
+    """
+
+    def __init__(self, addresses=None, error_callback=None, check_crc=True, metrics=None):
+        """
+        addresses: packet addresses to reassemble, or None for all
+        error_callback: called with any InvalidCrcError or IncompleteDatagroupError
+        check_crc: check the CRC of each datagroup
+        metrics: metrics to count datagroups and errors for each address in, by default the default metrics
+        """
+        self.addresses = frozenset(addresses) if addresses is not None else None
+        self.error_callback = error_callback
+        self.check_crc = check_crc
+        self.metrics = metrics if metrics is not None else get_metrics()
+        self.states = {}
+
+    def push(self, packet):
+        """Add a packet, returning the datagroup it completes, if any"""
+
+        address = packet.address
+        if self.addresses is not None and address not in self.addresses: return None
+        state = self.states.get(address)
+        if state is None: state = self.states[address] = ReassemblyState(address)
+        state.packets += 1
+
+        # a break in continuity loses the datagroup in progress
+        if state.index is not None and packet.index != (state.index + 1) % 4:
+            state.continuity_errors += 1
+            self.metrics.increment('datagroups.continuity_errors', address=address)
+            if state.buf is not None: self._abandon(state, 'continuity break from index %d to %d on address %d' % (state.index, packet.index, address))
+        state.index = packet.index
+
+        if not len(packet.data): return None # padding
+        if packet.first:
+            if state.buf is not None: self._abandon(state, 'new datagroup started on address %d' % address)
+            state.buf = bytearray()
+            state.crc.reset()
+            state.crc_fed = 0
+        elif state.buf is None:
+            return None
+        buf = state.buf
+        buf += packet.data
+
+        # accumulate the CRC, holding back the last two bytes which may be the CRC itself
+        if len(buf) - 2 > state.crc_fed:
+            state.crc.update(memoryview(buf)[state.crc_fed:len(buf) - 2])
+            state.crc_fed = len(buf) - 2
+
+        if not packet.last: return None
+        state.buf = None
+        try:
+            datagroup = Datagroup.frombytes(buf, check_crc=False)
+            if self.check_crc and datagroup.crc_enabled:
+                crc = (buf[datagroup.size - 2] << 8) | buf[datagroup.size - 1]
+                calculated = state.crc.value if datagroup.size == len(buf) else calculate_crc(memoryview(buf)[:datagroup.size - 2])
+                if crc != calculated: raise InvalidCrcError(crc, bytes(buf))
+        except IncompleteDatagroupError as ide:
+            state.incomplete += 1
+            self.metrics.increment('datagroups.incomplete', address=address)
+            if self.error_callback: self.error_callback(ide)
+            return None
+        except InvalidCrcError as ice:
+            state.crc_errors += 1
+            self.metrics.increment('datagroups.crc_errors', address=address)
+            if self.error_callback: self.error_callback(ice)
+            return None
+        state.datagroups += 1
+        if self.metrics.enabled: self.metrics.increment('datagroups.decoded', address=address)
+        return datagroup
+
+    def _abandon(self, state, reason):
+        logger.debug('abandoning datagroup: %s', reason)
+        state.buf = None
+        state.incomplete += 1
+        self.metrics.increment('datagroups.incomplete', address=state.address)
+        if self.error_callback: self.error_callback(IncompleteDatagroupError(reason))
+
+    def reassemble(self, packets):
+        """Generator function yielding (address, datagroup) for each datagroup reassembled from the packets"""
+        for packet in packets:
+            datagroup = self.push(packet)
+            if datagroup is not None:
+                yield packet.address, datagroup
 
 class IncompleteDatagroupError(Exception):
     pass
@@ -339,6 +652,7 @@ class Datagroup:
         self.segment_index = segment_index
         self.last = last
         self.size = 7 + 2 + len(self._data) + 2 # encoded datagroup size for chunking = [dg header] + [segment header] + [data] + [crc]
+        self.cache = None # optional dictionary of encoded datagroups, shared with others
         
     def __eq__(self, other):    
         if not isinstance(other, Datagroup): return False
@@ -353,74 +667,125 @@ class Datagroup:
     def get_data(self):
         return self._data
     
+    def _cache_key(self):
+        """key for the encoded bytes in a cache, on every field they are encoded from besides the data"""
+        return (self._transport_id, self._type, self.segment_index, self.continuity, self.repetition, self.crc_enabled, self.last)
+
     def tobytes(self):
-        
-        bits = bitarray()
-        
+
+        if self.cache is not None:
+            key = self._cache_key()
+            encoded = self.cache.get(key)
+            if encoded is None: encoded = self.cache[key] = self._encode()
+            return encoded
+        return self._encode()
+
+    def _encode(self):
+
+        data = self._data
+        buf = bytearray(7 + len(data) + 2)
+
         # datagroup header
-        bits += bitarray('0') # (0): ExtensionFlag - 0=no extension
-        bits += bitarray('1' if self.crc_enabled else '0') # (1): CrcFlag - true if there is a CRC at the end of the datagroup
-        bits += bitarray('1') # (2): SegmentFlag - 1=segment header included
-        bits += bitarray('1') # (3): UserAccessFlag - true
-        bits += int_to_bitarray(self._type, 4) # (4-7): DataGroupType
-        bits += int_to_bitarray(self.continuity % 16, 4) # (8-11): ContinuityIndex
-        bits += int_to_bitarray(self.repetition, 4) # (12-15): RepetitionIndex - remaining = 0 (only this once)
-        
+        # (0): ExtensionFlag - 0=no extension
+        # (1): CrcFlag - true if there is a CRC at the end of the datagroup
+        # (2): SegmentFlag - 1=segment header included
+        # (3): UserAccessFlag - true
+        # (4-7): DataGroupType
+        # (8-11): ContinuityIndex
+        # (12-15): RepetitionIndex - remaining = 0 (only this once)
+        #
         # session header
         # segment field
-        bits += bitarray('1' if self.last else '0') # (16): Last - true if the last segment
-        bits += int_to_bitarray(self.segment_index, 15) # (17-32): SegmentNumber
-        
+        # (16): Last - true if the last segment
+        # (17-31): SegmentNumber
+        #
         # user access field
-        bits += bitarray('000') # (33-35): RFA
-        bits += bitarray('1') # (36): TransportId - true to include Transport ID
-        bits += int_to_bitarray(2, 4) # (37-40): LengthIndicator - length of transport Id and End user address fields (will be 2 bytes as only transport ID defined)
-        bits += int_to_bitarray(self._transport_id, 16) # (41-56) transport ID
-
-        # data field
-        tmp = bitarray()
-        tmp.frombytes(self._data)
-        bits += tmp
-        
+        # (32-34): RFA
+        # (35): TransportId - true to include Transport ID
+        # (36-39): LengthIndicator - length of transport Id and End user address fields (will be 2 bytes as only transport ID defined)
+        # (40-55) transport ID
+        _HEADER.pack_into(buf, 0,
+                          (0x40 if self.crc_enabled else 0x00) | 0x30 | (self._type & 0x0f),
+                          ((self.continuity % 16) << 4) | (self.repetition & 0x0f),
+                          (0x8000 if self.last else 0x0000) | (self.segment_index & 0x7fff),
+                          0x12,
+                          self._transport_id & 0xffff)
+
+        # data field, written straight from the view over the segment data
+        if isinstance(data, Segment): data.write_into(buf, 7)
+        else: buf[7:-2] = data
+
         # CRC
-        crc = 0;
-        if self.crc_enabled: crc = calculate_crc(bits.tobytes())
-        bits += int_to_bitarray(crc, 16)
+        crc = 0
+        if self.crc_enabled: crc = calculate_crc(memoryview(buf)[:-2])
+        _CRC.pack_into(buf, len(buf) - 2, crc)
 
-        return bits.tobytes()
+        return bytes(buf)
     
     @staticmethod
     def frombits(bits, i=0, check_crc=True):
         """Parse a datagroup from a bitarray, with an optional offset"""
-       
+
+        if i % 8: bits, i = bits[i:], 0
+        datagroup = Datagroup.frombytes(memoryview(bits)[:len(bits) // 8], i // 8, check_crc=check_crc)
+        datagroup._data = datagroup._data.tobytes()
+
+        return datagroup
+
+    @staticmethod
+    def frombytes(buf, offset=0, check_crc=True):
+        """Parse a datagroup from a bytes-like object, with an optional byte offset.
+
+        The data of the returned datagroup is a memoryview onto the given buffer"""
+
+        view = buf if isinstance(buf, memoryview) else memoryview(buf)
+        length = len(view)
+
         # check we have enough header first
-        if (len(bits) - i) < ((9 + 2) * 8): raise IncompleteDatagroupError
-       
+        if (length - offset) < (9 + 2): raise IncompleteDatagroupError
+
         # datagroup header
-        type = int(bits[4:8].to01(), 2)
-        continuity = int(bits[8:12].to01(), 2)
-        repetition = int(bits[12:16].to01(), 2)
-                
+        flags = view[offset]
+        crc_enabled = bool(flags & 0x40)
+        type = flags & 0x0f
+        continuity = view[offset + 1] >> 4
+        repetition = view[offset + 1] & 0x0f
+        i = offset + 2
+        if flags & 0x80: i += 2 # extension field
+
         # session header
         # segment field
-        last = bits[16]
-        segment_index = int(bits[17:32].to01(), 2)
-        
+        last = False
+        segment_index = 0
+        if flags & 0x20:
+            last = bool(view[i] & 0x80)
+            segment_index = ((view[i] & 0x7f) << 8) | view[i + 1]
+            i += 2
+
         # user access field
-        transport_id = int(bits[40:56].to01(), 2)
+        transport_id = None
+        if flags & 0x10:
+            if i >= length: raise IncompleteDatagroupError
+            user_access = view[i]
+            if user_access & 0x10 and i + 2 < length:
+                transport_id = (view[i + 1] << 8) | view[i + 2]
+            i += 1 + (user_access & 0x0f) # LengthIndicator
 
         # data segment header
-        size = int(bits[59:72].to01(), 2) # get size to check we have a complete datagroup
-        if len(bits) < 72 + size * 8 + 16: raise IncompleteDatagroupError
-        data = bits[72 : 72 + (size*8)]
-        if check_crc:
-            crc = int(bits[72 + len(data) : 72 + len(data) + 16].to01(), 2)
-            calculated = calculate_crc(bits[:72+len(data)].tobytes())
-            if crc != calculated: raise InvalidCrcError(crc, bits[:72+len(data) + 16].tobytes())  
-        
-        datagroup = Datagroup(transport_id, type, data.tobytes(), segment_index, continuity, True, repetition, last)
+        if i + 2 > length: raise IncompleteDatagroupError
+        size = ((view[i] & 0x1f) << 8) | view[i + 1] # get size to check we have a complete datagroup
+        i += 2
+        end = i + size + 2
+        if length < end: raise IncompleteDatagroupError
+        if check_crc and crc_enabled:
+            crc = (view[end - 2] << 8) | view[end - 1]
+            calculated = calculate_crc(view[offset : end - 2])
+            if crc != calculated: raise InvalidCrcError(crc, view[offset : end].tobytes())
+
+        datagroup = Datagroup(transport_id, type, view[i : i + size], segment_index, continuity, crc_enabled, repetition, last)
+        datagroup.size = end - offset
         logger.debug('parsed datagroup: %s', datagroup)
-        
+
         return datagroup
     
     def __str__(self):
@@ -429,18 +794,179 @@ class Datagroup:
         elif self._type == 6: type_description = 'MOT Directory (uncompressed)'
         elif self._type == 7: type_description = 'MOT Directory (compressed)'
         else: type_description = 'unknown'
-        return '[segment=%d bytes], type=%d [%s], transportid=%d, segmentindex=%d, continuity=%d, last=%s' % (len(self._data), self._type, type_description, self._transport_id, self.segment_index, self.continuity, self.last)
+        return '[segment=%d bytes], type=%d [%s], transportid=%s, segmentindex=%d, continuity=%d, last=%s' % (len(self._data), self._type, type_description, self._transport_id, self.segment_index, self.continuity, self.last)
         
     def __repr__(self):
         return '<DataGroup: %s>' % str(self)
     
+class CarouselScheduler:
+    """
+    Schedules one cycle of a directory mode carousel within a bitrate budget
+
+    Each object is transmitted a number of times per cycle, with its segments spread
+    evenly through the cycle and interleaved with those of other objects, and objects
+    of a higher priority going first where segments fall at the same point. The
+    directory is repeated a number of times per cycle, evenly spaced between body
+    segments, or as often as needed for it to be repeated within the given directory
+    interval.
+
+    The cycle time is calculated from the packets needed to carry each datagroup
+    at the given bitrate, in bits per second.
+    """
+
+    def __init__(self, bitrate, directory_repetition=1, directory_interval=None, packet_size=Packet.SIZE_96):
+        if bitrate <= 0: raise ValueError('bitrate must be greater than zero')
+        if directory_repetition < 1: raise ValueError('directory repetition must be at least one')
+        self.bitrate = bitrate
+        self.directory_repetition = directory_repetition
+        self.directory_interval = directory_interval
+        self.packet_size = packet_size
+        self.objects = {}
+        self.cycle_time = 0
+        self.achieved_directory_interval = 0
+
+    def set_object(self, object, repetition=1, priority=0):
+        """set the number of transmissions per cycle and the priority of an object"""
+        if repetition < 1: raise ValueError('object repetition must be at least one')
+        self.objects[object.get_transport_id()] = (repetition, priority)
+
+    def transmitted_size(self, datagroup):
+        """bytes of packets needed to carry a datagroup"""
+        length = 7 + len(datagroup.get_data()) + 2
+        chunk_size = self.packet_size - 5
+        full, remainder = divmod(length, chunk_size)
+        return full * self.packet_size + (_required_size(remainder, self.packet_size) if remainder else 0)
+
+    def duration(self, datagroups):
+        """time in seconds to transmit a set of datagroups"""
+        return sum(self.transmitted_size(d) for d in datagroups) * 8.0 / self.bitrate
+
+    def carousel_period(self, cycle_time=None):
+        """carousel period to signal in the directory, in tenths of seconds"""
+        if cycle_time is None: cycle_time = self.cycle_time
+        return int(math.ceil(cycle_time * 10))
+
+    def schedule(self, directory, bodies):
+        """
+        Schedule one cycle from the directory datagroups and the body datagroups
+        of each object, as (transport ID, datagroups) pairs, returning the datagroups
+        for the cycle
+
+        Directory and body continuity indices are assigned in order of transmission,
+        on copies of any datagroups whose continuity index changes, so the datagroups
+        given are left alone. The cycle is padded so that the body continuity index
+        starts from zero again on the next cycle.
+        """
+
+        # place each segment of each transmission of an object at its ideal point in the
+        # cycle, so that the segments of objects are interleaved
+        transmissions = []
+        for n, (transport_id, datagroups) in enumerate(bodies):
+            repetition, priority = self.objects.get(transport_id, (1, 0))
+            for k in range(repetition):
+                for j, datagroup in enumerate(datagroups):
+                    transmissions.append(((k + j / float(len(datagroups))) / repetition, -priority, n, k, j, datagroup))
+        transmissions.sort(key=lambda t: t[:5])
+
+        # body datagroups in order
+        segments = []
+        continuity_body = 0
+        for _, _, _, _, _, datagroup in transmissions:
+            segments.append(_renumbered(datagroup, continuity_body))
+            continuity_body = (continuity_body + 1) % 16
+        segments.extend(_continuity_padding(continuity_body))
+
+        # repeat the directory often enough to meet the interval, but no more than once per segment
+        body_size = sum(self.transmitted_size(d) for d in segments)
+        directory_size = sum(self.transmitted_size(d) for d in directory)
+        repetition = self.directory_repetition
+        if self.directory_interval:
+            available = self.directory_interval * self.bitrate / 8.0 - directory_size
+            needed = int(math.ceil(body_size / available)) if available > 0 else len(segments)
+            repetition = max(repetition, needed)
+        repetition = max(1, min(repetition, len(segments))) if segments else 1
+
+        # interleave the directory evenly between body segments
+        datagroups = []
+        position = 0
+        starts = []
+        for datagroup in segments:
+            if len(starts) < repetition and position >= len(starts) * body_size / float(repetition):
+                starts.append(position + len(starts) * directory_size)
+                datagroups.extend(directory)
+            datagroups.append(datagroup)
+            position += self.transmitted_size(datagroup)
+        while len(starts) < repetition:
+            starts.append(position + len(starts) * directory_size)
+            datagroups.extend(directory)
+
+        # directory datagroups in order, as for the bodies
+        continuity_directory = 0
+        for i, datagroup in enumerate(datagroups):
+            if datagroup.get_type() == DIRECTORY_UNCOMPRESSED:
+                datagroups[i] = _renumbered(datagroup, continuity_directory)
+                continuity_directory = (continuity_directory + 1) % 16
+
+        cycle_size = body_size + repetition * directory_size
+        gaps = [b - a for a, b in zip(starts, starts[1:] + [starts[0] + cycle_size])]
+        self.cycle_time = cycle_size * 8.0 / self.bitrate
+        self.achieved_directory_interval = max(gaps) * 8.0 / self.bitrate
+        logger.debug('scheduled carousel of %d datagroups with %d directory repetitions: cycle time %.1fs, directory interval %.1fs',
+                     len(datagroups), repetition, self.cycle_time, self.achieved_directory_interval)
+        return datagroups
+
+class _EncodedObject:
+    """Directory entry and body datagroups encoded for an object, kept until the object changes"""
+
+    def __init__(self, object, segmenting_strategy):
+        self.object = object
+        self.body = object.get_body()
+        self.parameters = object.get_parameters()
+        self.type = object.get_type()
+        self.segmenting_strategy = segmenting_strategy
+        self.entry = _encode_directory_entry(object)
+        self.datagroups = _body_datagroups(object, segmenting_strategy or ConstantSegmentSize())
+
+    def matches(self, object, segmenting_strategy):
+        """whether this encoding is still current for the object"""
+        if object is not self.object or segmenting_strategy is not self.segmenting_strategy: return False
+        if object.get_body() is not self.body or object.get_type() is not self.type: return False
+        parameters = object.get_parameters()
+        return len(parameters) == len(self.parameters) and all(a is b for a, b in zip(parameters, self.parameters))
+
 class DirectoryDatagroupEncoder(DirectoryEncoder):
+    """
+    Encodes a directory mode carousel from a set of MOT objects, iterating over its
+    datagroups
+
+    The directory entry and body datagroups of each object are kept between regenerations,
+    so that adding, removing or changing an object only encodes the directory again,
+    along with the bodies of that object.
+
+    The encoded bytes of each datagroup are cached once encoded, keyed on every field
+    of the datagroup besides its data, and the carousel can also be iterated over as
+    cached encoded packets. Cached datagroups are kept when the carousel regenerates
+    only for unchanged objects that keep their continuity indices, and cached packets
+    are not kept at all.
+
+    An optional CarouselScheduler orders each cycle within a bitrate budget, repeating
+    the directory and objects as configured, and the carousel period it calculates
+    is signalled in the directory.
 
-    def __init__(self, segmenting_strategy=None, single=False):
+    Each regeneration is counted in the metrics, by default the default metrics,
+    along with the objects encoded and the size and any scheduled time of the cycle.
+    """
+
+    def __init__(self, segmenting_strategy=None, single=False, scheduler=None, metrics=None):
         DirectoryEncoder.__init__(self)
         self.segmenting_strategy = segmenting_strategy
         self.single = single
+        self.scheduler = scheduler
+        self.metrics = metrics if metrics is not None else get_metrics()
         self.datagroups = []
+        self.encoded = {}
+        self.cache = {}
+        self.packet_cache = {}
         self.regenerate()
 
     def add(self, object):
@@ -468,10 +994,80 @@ class DirectoryDatagroupEncoder(DirectoryEncoder):
 
     def regenerate(self):
         """called when the directory needs to regenerate"""
-        self.datagroups = encode_directorymode(self.objects, directory_parameters=[SortedHeaderInformation()], segmenting_strategy=self.segmenting_strategy) 
+
+        # encode only new or changed objects
+        encoded = {}
+        reused = set()
+        for object in self.objects:
+            transport_id = object.get_transport_id()
+            e = self.encoded.get(transport_id)
+            if e is not None and e.matches(object, self.segmenting_strategy): reused.add(transport_id)
+            else: e = _EncodedObject(object, self.segmenting_strategy)
+            encoded[transport_id] = e
+        logger.debug('regenerating directory with %d objects, %d unchanged', len(self.objects), len(reused))
+        self.encoded = encoded
+
+        segmenting_strategy = self.segmenting_strategy or ConstantSegmentSize()
+        entries = b''.join([encoded[object.get_transport_id()].entry for object in self.objects])
+        directory = _directory_datagroups(_encode_directory(entries, len(self.objects), [SortedHeaderInformation()]), segmenting_strategy)
+
+        if self.scheduler is not None:
+            datagroups = self.scheduler.schedule(directory, [(object.get_transport_id(), encoded[object.get_transport_id()].datagroups) for object in self.objects])
+
+            # the carousel period is known once scheduled, and does not change the size of the directory
+            period = self.scheduler.carousel_period()
+            segments = _segment(_encode_directory(entries, len(self.objects), [SortedHeaderInformation()], period), segmenting_strategy)
+            for datagroup in datagroups:
+                if datagroup.get_type() == DIRECTORY_UNCOMPRESSED: datagroup._data = segments[datagroup.segment_index]
+        else:
+            # fix up body continuity
+            datagroups = directory
+            continuity_body = 0
+            for object in self.objects:
+                for body_group in encoded[object.get_transport_id()].datagroups:
+                    datagroups.append(_renumbered(body_group, continuity_body))
+                    continuity_body = (continuity_body + 1) % 16
+            datagroups.extend(_continuity_padding(continuity_body))
+
+        # keep encoded bytes where nothing has changed
+        cache = {}
+        for datagroup in datagroups:
+            if datagroup.get_type() == BODY and datagroup.get_transport_id() in reused:
+                key = datagroup._cache_key()
+                if key in self.cache: cache[key] = self.cache[key]
+
+        self.datagroups = datagroups
+        self.cache = cache
+        self.packet_cache = {}
+        self.metrics.increment('carousel.regenerations')
+        self.metrics.increment('carousel.objects_encoded', len(self.objects) - len(reused))
+        if self.metrics.enabled:
+            self.metrics.observe('carousel.cycle_bytes', sum(7 + len(datagroup.get_data()) + 2 for datagroup in datagroups))
+            if self.scheduler is not None: self.metrics.observe('carousel.cycle_time', self.scheduler.cycle_time)
+        for datagroup in self.datagroups: datagroup.cache = self.cache
         if self.single: self.iterator = iter(self.datagroups)
         else: self.iterator = itertools.cycle(self.datagroups)
 
+    def packets(self, address=None, size=None):
+        """
+        Returns an iterator over the encoded bytes of the carousel as packets
+
+        The packets for a whole number of carousel cycles are encoded once and
+        cached, enough for the packet continuity index to run on across the end
+        of one cycle into the start of the next.
+        """
+        key = (address, size)
+        packets = self.packet_cache.get(key)
+        if packets is None:
+            cycles = 1
+            if not self.single:
+                chunk_size = (size or Packet.SIZE_96) - 5
+                n = sum((len(d.tobytes()) + chunk_size - 1) // chunk_size for d in self.datagroups)
+                cycles = 4 // math.gcd(n, 4)
+            packets = self.packet_cache[key] = list(iter_packets(self.datagroups * cycles, address, size, raw=True, metrics=self.metrics))
+        if self.single: return iter(packets)
+        else: return itertools.cycle(packets)
+
     def __iter__(self):
         return self.iterator
 
@@ -0,0 +1,141 @@
+import bisect
+import threading
+
+class Metrics:
+    """
+    Interface for recording counters and histograms from the encoders, decoders and
+    transports, which records nothing
+
+    Metrics are named, with optional labels such as the packet address. Anything
+    recorded for each packet or datagroup is only recorded when the metrics are
+    enabled, so that the default costs no more than checking the flag.
+    """
+
+    enabled = False
+
+    def increment(self, name, value=1, **labels):
+        """Add to a counter"""
+        pass
+
+    def observe(self, name, value, **labels):
+        """Add an observation to a histogram"""
+        pass
+
+class Histogram:
+    """Count, sum and range of observations, with a count for each bucket by upper bound"""
+
+    # by default, buckets for timings in seconds from 1ms to a minute
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    # buckets for sizes in bytes, from a packet to 16MB
+    BYTE_BUCKETS = (96, 256, 1024, 4096, 16384, 65536, 1 << 18, 1 << 20, 1 << 22, 1 << 24)
+
+    def __init__(self, buckets=None):
+        self.buckets = tuple(sorted(buckets or Histogram.BUCKETS))
+        self.counts = [0] * (len(self.buckets) + 1) # last for observations above the buckets
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if self.min is None or value < self.min: self.min = value
+        if self.max is None or value > self.max: self.max = value
+
+    def mean(self):
+        return self.sum / self.count if self.count else None
+
+    def quantile(self, q):
+        """upper bound of the bucket holding the given quantile, or the maximum if above the buckets"""
+        if not self.count: return None
+        n = q * self.count
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            if total >= n: return min(bound, self.max)
+        return self.max
+
+    def __str__(self):
+        return 'count=%d, sum=%s, min=%s, max=%s' % (self.count, self.sum, self.min, self.max)
+
+    def __repr__(self):
+        return '<Histogram: %s>' % str(self)
+
+# buckets for the metrics not measured in seconds, keyed on metric name
+BUCKETS = {
+    'packets.bytes_to_lock': Histogram.BYTE_BUCKETS,
+    'carousel.cycle_bytes': Histogram.BYTE_BUCKETS,
+}
+
+class MemoryMetrics(Metrics):
+    """
+    Metrics kept in memory, keyed on name and labels, for reading back or exporting
+    periodically. Metrics can be recorded from any thread.
+    """
+
+    enabled = True
+
+    def __init__(self, buckets=None):
+        """
+        buckets: upper bounds of the histogram buckets, keyed on metric name, for any
+                 metrics not using the default buckets, in addition to those in BUCKETS
+        """
+        self.buckets = dict(BUCKETS)
+        if buckets: self.buckets.update(buckets)
+        self.counters = {}
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(name, labels):
+        return (name, tuple(sorted(labels.items()))) if labels else (name, ())
+
+    def increment(self, name, value=1, **labels):
+        key = MemoryMetrics._key(name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = MemoryMetrics._key(name, labels)
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None: histogram = self.histograms[key] = Histogram(self.buckets.get(name))
+            histogram.observe(value)
+
+    def counter(self, name, **labels):
+        """value of a counter, summed over any labels not given"""
+        with self._lock:
+            return sum(value for (n, l), value in self.counters.items() if n == name and all(item in l for item in labels.items()))
+
+    def histogram(self, name, **labels):
+        """histogram for a metric with exactly the given labels, or None if nothing has been observed"""
+        with self._lock:
+            return self.histograms.get(MemoryMetrics._key(name, labels))
+
+    def snapshot(self):
+        """dictionary of the counters and histograms, keyed on name with any labels as name{label=value,...}"""
+        def label(name, labels):
+            return '%s{%s}' % (name, ','.join('%s=%s' % item for item in labels)) if labels else name
+        with self._lock:
+            snapshot = dict((label(name, labels), value) for (name, labels), value in self.counters.items())
+            for (name, labels), histogram in self.histograms.items():
+                snapshot[label(name, labels)] = {'count': histogram.count, 'sum': histogram.sum, 'min': histogram.min, 'max': histogram.max}
+        return snapshot
+
+    def reset(self):
+        with self._lock:
+            self.counters = {}
+            self.histograms = {}
+
+# default metrics, used by anything not given its own
+metrics = Metrics()
+def get_metrics():
+    return metrics
+
+def set_metrics(m):
+    """Set the default metrics, for anything created from then on"""
+    global metrics
+    metrics = m if m is not None else Metrics()
@@ -1,9 +1,19 @@
 from bitarray import bitarray
-from msc import bitarray_to_hex, int_to_bitarray, calculate_crc, InvalidCrcError
+from msc import bitarray_to_hex, int_to_bitarray, calculate_crc, InvalidCrcError, BufferedDecoder, _is_buffer
+from msc.metrics import get_metrics
 import logging
+import struct
 
 logger = logging.getLogger('dabdata.packets')
 
+# packed packet header (3 bytes) and CRC
+_HEADER = struct.Struct('>BBB')
+_CRC = struct.Struct('>H')
+
+# packet length field, from the 2-bit code to the packet size in bytes and back
+_SIZES = (24, 48, 72, 96)
+_LENGTH_CODES = {24: 0x00, 48: 0x40, 72: 0x80, 96: 0xc0}
+
 class IncompletePacketError(Exception):
     pass
 
@@ -25,49 +35,63 @@ class Packet:
         
     def tobytes(self):
         
-        bits = bitarray()
+        n = len(self.data)
+        buf = bytearray(self.size) # zeroed, so includes any padding
         
         # build header
-        bits += int_to_bitarray((self.size / 24) - 1, 2) # (0-1): packet length
-        bits += int_to_bitarray(self.index, 2) # (2-3): continuity index
-        bits += bitarray('1' if self.first else '0') # (4): first packet of datagroup series
-        bits += bitarray('1' if self.last else '0') # (5): last packet of datagroup series
-        bits += int_to_bitarray(self.address, 10) # (6-15): packet address
-        bits += bitarray('0') # (16): Command flag = 0 (data)
-        bits += int_to_bitarray(len(self.data), 7) # (17-23): useful data length
+        # (0-1): packet length
+        # (2-3): continuity index
+        # (4): first packet of datagroup series
+        # (5): last packet of datagroup series
+        # (6-15): packet address
+        # (16): Command flag = 0 (data)
+        # (17-23): useful data length
+        _HEADER.pack_into(buf, 0, 
+                          _LENGTH_CODES[self.size] | ((self.index & 0x03) << 4) | (0x08 if self.first else 0x00) | (0x04 if self.last else 0x00) | ((self.address >> 8) & 0x03),
+                          self.address & 0xff,
+                          n & 0x7f)
 
         # add the packet data
-        tmp = bitarray()
-        if len(self.data) > 0:
-            tmp.frombytes(self.data)
-            bits += tmp # (24-n): packet data
-                    
-        # add packet padding if needed
-        bits += bitarray('0'*(self.size - len(self.data) - 5)*8)
+        buf[3:3+n] = self.data # (24-n): packet data
         
         # add CRC
-        bits += int_to_bitarray(calculate_crc(bits.tobytes()), 16)
+        _CRC.pack_into(buf, self.size - 2, calculate_crc(memoryview(buf)[:-2]))
         
-        return bits.tobytes()
+        return bytes(buf)
 
     @staticmethod
     def frombits(bits, i=0, check_crc=True):
         """Parse a packet from a bitarray, with an optional offset"""
         
-        size = (int(bits[i+0:i+2].to01(), 2) + 1) * 24
-        if (len(bits) - i) < (size * 8): raise IncompletePacketError('length of bitarray is less than passed data length %d bytes < %d bytes', len(bits) / 8, size)
-        index = int(bits[i+2:i+4].to01(), 2)
-        first = bits[i+4]
-        last = bits[i+5]
-        address = int(bits[i+6:i+16].to01(), 2)
-        data_length = int(bits[i+17:i+24].to01(), 2)
-        data = bits[i+24:i+24+(data_length*8)]
-        crc = int(bits[i + (size * 8) - 16 : i + (size * 8)].to01(), 2)
-        if check_crc:        
-            calculated = calculate_crc(bits[i + 0 : i +(size * 8) - 16].tobytes())
+        if i % 8: bits, i = bits[i:], 0
+        packet = Packet.frombytes(memoryview(bits)[:len(bits) // 8], i // 8, check_crc=check_crc)
+        packet.data = packet.data.tobytes()
+        
+        return packet
+
+    @staticmethod
+    def frombytes(buf, offset=0, check_crc=True):
+        """Parse a packet from a bytes-like object, with an optional byte offset.
+
+        The data of the returned packet is a memoryview onto the given buffer"""
+
+        view = buf if isinstance(buf, memoryview) else memoryview(buf)
+        if offset >= len(view): raise IncompletePacketError('no data to parse a packet from')
+        header = view[offset]
+        size = _SIZES[header >> 6]
+        if (len(view) - offset) < size: raise IncompletePacketError('length of buffer is less than packet length %d bytes < %d bytes' % (len(view) - offset, size))
+        index = (header >> 4) & 0x03
+        first = bool(header & 0x08)
+        last = bool(header & 0x04)
+        address = ((header & 0x03) << 8) | view[offset + 1]
+        data_length = view[offset + 2] & 0x7f
+        data = view[offset + 3 : offset + 3 + data_length]
+        if check_crc:
+            crc = (view[offset + size - 2] << 8) | view[offset + size - 1]
+            calculated = calculate_crc(view[offset : offset + size - 2])
             if crc != calculated:
-                raise InvalidCrcError(crc, bits[i + 0 : i +(size * 8)].tobytes())
-        packet = Packet(size, address, data.tobytes(), first, last, index)
+                raise InvalidCrcError(crc, view[offset : offset + size].tobytes())
+        packet = Packet(size, address, data, first, last, index)
         logger.debug('parsed packet: %s', packet)
         
         return packet
@@ -78,142 +102,241 @@ class Packet:
     def __repr__(self):
         return '<Packet: %s>' % str(self)
 
-def encode_packets(datagroups, address=None, size=None, continuity=None, padding=False):
+def _required_size(payload_size, max_packet_size):
+    """smallest packet size that will hold the payload, up to the maximum packet size"""
+    if payload_size > (max_packet_size-5):
+      return max_packet_size
+    if payload_size > (72-5):
+      return Packet.SIZE_96
+    elif payload_size > (48-5):
+      return Packet.SIZE_72
+    elif payload_size > (24-5):
+      return Packet.SIZE_48
+    else:
+      return Packet.SIZE_24 
+
+def iter_packets(datagroups, address=None, size=None, continuity=None, padding=False, raw=False, metrics=None):
 
     """
-    Encode a set of datagroups into packets
+    Generator function to encode datagroups into packets as they are needed
+
+    The datagroups may be any iterable, including an endless one such as a carousel,
+    of either Datagroup objects or already encoded datagroup bytes. Only one datagroup 
+    is held at a time.
+
+    continuity: dictionary of the last continuity index used for each packet address,
+                which is updated as packets are generated
+    padding: once the datagroups are exhausted, add padding packets (carrying no data)
+             until the continuity index ends on 3
+    raw: yield the encoded bytes of each packet rather than Packet objects
+    metrics: metrics to count the packets encoded for each address in, by default the default metrics
     """
 
-    def get_continuity_index(address):
-        index=0
-        if address in continuity:
-            index = continuity[address]
-            index += 1
-            if index > 3: index = 0
-        continuity[address] = index
-        return index
-
-    def get_required_size(payload_size, max_packet_size):
-        if payload_size > (max_packet_size-5):
-          return max_packet_size
-        if payload_size > (72-5):
-          return Packet.SIZE_96
-        elif payload_size > (48-5):
-          return Packet.SIZE_72
-        elif payload_size > (24-5):
-          return Packet.SIZE_48
-        else:
-          return Packet.SIZE_24 
-          
     if not address: address = 1
     if not size: size = Packet.SIZE_96
-    if not continuity: continuity = {}
-    if not padding: padding = False
+    if continuity is None: continuity = {}
 
     if address < 1 or address > 1024: raise ValueError('packet address must be greater than zero and less than 1024')
     if size not in Packet.sizes: raise ValueError('packet size %d must be one of: %s' % (size, Packet.sizes))
-    
-    packets = []
-    
+    if metrics is None: metrics = get_metrics()
+
+    chunk_size = size - 5
+    index = continuity.get(address, -1)
+    for datagroup in datagroups:
+        data = datagroup if isinstance(datagroup, (bytes, bytearray, memoryview)) else datagroup.tobytes()
+        if raw: data = memoryview(data)
+        length = len(data)
+        for i in range(0, length, chunk_size):
+            chunk = data[i:i+chunk_size]
+            index = (index + 1) % 4
+            continuity[address] = index
+            packet = Packet(_required_size(len(chunk), size), address, chunk, i == 0, i + chunk_size >= length, index)
+            if metrics.enabled: metrics.increment('packets.encoded', address=address)
+            yield packet.tobytes() if raw else packet
+
+    # add padding packets to make sure the Continuity Index ends with 3
+    while padding and index != 3:
+        index = (index + 1) % 4
+        continuity[address] = index
+        packet = Packet(Packet.SIZE_24, address, b'', True, True, index)
+        if metrics.enabled: metrics.increment('packets.padding', address=address)
+        yield packet.tobytes() if raw else packet
+
+def encode_packets(datagroups, address=None, size=None, continuity=None, padding=False, metrics=None):
+
+    """
+    Encode a set of datagroups into packets
+    """
+
+    if not continuity: continuity = {}
+    if padding and not isinstance(datagroups, list): datagroups = list(datagroups)
+
     # encode the datagroups into a continuous datastream
     # repeating sufficient times to make sure the final continuity index is 3
     # this could make the output filesize x2 or x4 the minimum size
+    packets = []
     while True:
-        for datagroup in datagroups:
-            data = datagroup.tobytes()
-            chunk_size = size - 5
-            for i in range(0, len(data), chunk_size):
-                chunk = data[i:i+chunk_size if i+chunk_size < len(data) else len(data)]
-                continuity_index = get_continuity_index(address)
-                packet = Packet(get_required_size(len(chunk),size), address, chunk, True if i == 0 else False, True if i+chunk_size >= len(data) else False, continuity_index)
-                packets.append(packet)
-        if padding == False or (padding == True and continuity_index == 3):
+        packets.extend(iter_packets(datagroups, address, size, continuity, metrics=metrics))
+        if not padding or not packets or packets[-1].index == 3:
             break
-        # add padding packets to make sure the Continuity Index ends with 3
-        # if padding and continuity_index != 3:
-        #    while continuity_index !=3:
-        #        continuity_index += 1
-        #        packet = Packet(size, address, [], True, True, continuity_index)
-        #        packets.append(packet)
         
     return packets
 
-def decode_packets(data, error_callback=None, check_crc=True, resync=True):
+class PacketDecoder(BufferedDecoder):
+    """
+    Stateful packet decoder, fed with chunks of a bitstream as they arrive and
+    iterated over for the packets that can be decoded from them so far.
+
+    On a CRC error the decoder loses lock and scans forward for the next offset
+    with a plausible packet header (data length fitting the packet size, and an
+    expected address if any are given), only calculating a CRC for those. Lock
+    is regained once `lock_threshold` valid packets follow on from each other,
+    or fewer if the decoder has been closed at the end of the bitstream.
+    The number of bytes skipped, and the length of bitstream it took to regain lock
+    after the last loss of lock, are kept on the decoder.
+    """
+
+    def __init__(self, error_callback=None, check_crc=True, resync=True, read_size=1024, buffer_size=65536, addresses=None, lock_threshold=3, locked=True, metrics=None):
+        """
+        error_callback: called with any InvalidCrcError
+        check_crc: check the CRC of each packet
+        resync: on a CRC error, scan for the next valid packet rather than skip the packet
+        read_size: number of bytes to read at a time when decoding from a file or socket
+        buffer_size: initial size of the buffer in bytes
+        addresses: packet addresses expected in the bitstream, packets for any others are skipped
+        lock_threshold: number of consecutive valid packets needed to regain lock
+        locked: whether the bitstream starts on a packet boundary, otherwise the decoder
+                starts by scanning for valid packets to lock onto
+        metrics: metrics to count packets and errors in, by default the default metrics
+        """
+        BufferedDecoder.__init__(self, read_size=read_size, buffer_size=max(buffer_size, Packet.SIZE_96))
+        self.error_callback = error_callback
+        self.check_crc = check_crc
+        self.resync = resync
+        self.addresses = frozenset(addresses) if addresses is not None else None
+        self.lock_threshold = max(1, lock_threshold)
+        self.metrics = metrics if metrics is not None else get_metrics()
+
+        # resynchronisation state and counters
+        self.locked = locked
+        self.crc_errors = 0
+        self.resyncs = 0
+        self.bytes_skipped = 0
+        self.bytes_to_lock = None # bytes of bitstream from losing lock to regaining it, for the last resync
+        self._lost_at = None if locked else 0 # offset in the bitstream lock was lost at
+
+    def __next__(self):
+        buf = self._buf
+        while self._end - self._start >= Packet.SIZE_24:
+            if not self.locked and not self._scan(): break
+            header = buf[self._start]
+            size = _SIZES[header >> 6]
+            if self._end - self._start < size: break
+            try:
+                if self.addresses is not None and (((header & 0x03) << 8) | buf[self._start + 1]) not in self.addresses:
+                    # skip without parsing, though still checking that lock is held
+                    if self.check_crc: self._check_crc(self._start, size)
+                    self._start += size
+                    continue
+                packet = Packet.frombytes(memoryview(buf)[:self._end], self._start, check_crc=self.check_crc)
+            except InvalidCrcError as ice:
+                self.crc_errors += 1
+                self.metrics.increment('packets.crc_errors')
+                if self.error_callback: self.error_callback(ice)
+                if self.resync:
+                    logger.debug('lost lock at CRC error, resynchronising')
+                    self.locked = False
+                    self._lost_at = self.tell()
+                    self._start += 1
+                    self.bytes_skipped += 1
+                    self.metrics.increment('packets.bytes_skipped')
+                else:
+                    self._start += size
+                continue
+            if not self._mapped: packet.data = packet.data.tobytes() # the buffer will be reused
+            self._start += size
+            if self.metrics.enabled: self.metrics.increment('packets.decoded', address=packet.address)
+            return packet
+        raise StopIteration
+
+    def _scan(self):
+        """Advance the read offset to the next offset that can be locked onto,
+           returning False if more data is needed first"""
+        i = self._start
+        while self._end - i >= 3:
+            valid = self._valid_run(i)
+            if valid is None: break
+            if valid:
+                self.bytes_skipped += i - self._start
+                if i > self._start: self.metrics.increment('packets.bytes_skipped', i - self._start)
+                self._start = i
+                self.locked = True
+                self.resyncs += 1
+                self.bytes_to_lock = self._discarded + i - self._lost_at
+                self.metrics.increment('packets.resyncs')
+                self.metrics.observe('packets.bytes_to_lock', self.bytes_to_lock)
+                logger.debug('regained lock after skipping %d bytes', self.bytes_skipped)
+                return True
+            i += 1
+        self.bytes_skipped += i - self._start
+        if i > self._start: self.metrics.increment('packets.bytes_skipped', i - self._start)
+        self._start = i
+        return False
+
+    def _valid_run(self, i):
+        """Returns whether a run of valid packets starts at the offset, or None if
+           there is not yet enough data to tell"""
+        buf = self._buf
+        view = memoryview(buf)
+        for n in range(self.lock_threshold):
+            if self._end - i < 3: return n > 0 if self._closed else None
+
+            # check the header is plausible before going to the CRC
+            header = buf[i]
+            size = _SIZES[header >> 6]
+            if (buf[i + 2] & 0x7f) > size - 5: return False
+            if n == 0 and self.addresses is not None and (((header & 0x03) << 8) | buf[i + 1]) not in self.addresses: return False
+
+            if self._end - i < size: return n > 0 if self._closed else None
+            if calculate_crc(view[i : i + size - 2]) != ((buf[i + size - 2] << 8) | buf[i + size - 1]): return False
+            i += size
+        return True
+
+    def _check_crc(self, i, size):
+        crc = (self._buf[i + size - 2] << 8) | self._buf[i + size - 1]
+        if calculate_crc(memoryview(self._buf)[i : i + size - 2]) != crc:
+            raise InvalidCrcError(crc, bytes(self._buf[i : i + size]))
+
+def decode_packets(data, error_callback=None, check_crc=True, resync=True, read_size=1024, addresses=None, metrics=None):
 
     """
     Generator function to decode packets from a bitstream
 
-    The bitstream may be presented as either a bitarray, a file object or a socket
+    The bitstream may be presented as either a bitarray, a file object, a socket or
+    a buffer such as an mmap, in which case the packet data are views into it
     """
        
+    decoder = PacketDecoder(error_callback=error_callback, check_crc=check_crc, resync=resync, read_size=read_size, addresses=addresses, metrics=metrics)
     if isinstance(data, bitarray):
         logger.debug('decoding packets from bitarray')
-        i = 0
-        while i < len(data):
-            while i < len(data):
-                if len(data) < 2: break
-                size = (int(data[i:i+2].to01(), 2) + 1) * 24
-                if len(data) < (size * 8): break
-                try:
-                    packet = Packet.frombits(data, i=i, check_crc=check_crc)
-                    yield packet
-                    i += (size * 8)
-                except (InvalidCrcError, ice):
-                    if error_callback: error_callback(ice) 
-                    if resync: i += 8
-                    else: i += (size * 8)
+        decoder.feed(memoryview(data)[:len(data) // 8])
+        decoder.close()
+        for packet in decoder:
+            yield packet
+    elif _is_buffer(data):
+        logger.debug('decoding packets from buffer: %s', type(data))
+        decoder.map(data)
+        for packet in decoder:
+            yield packet
     elif hasattr(data, 'read'):
         logger.debug('decoding packets from file: %s', data)
-        buf = bitarray()  
-        r = data.read(1024)
-        while len(r):
-            buf.frombytes(r)
-            logger.debug('chunking buffer of length %d bytes', len(buf)/8)
-            i = 0
-            while i < len(buf):
-                if len(buf) < 2: break
-                size = (int(buf[i:i+2].to01(), 2) + 1) * 24
-                if len(buf) < (size * 8): break
-                try:
-                    packet = Packet.frombits(buf, i=i, check_crc=check_crc)
-                    yield packet
-                    i += (size * 8)
-                except IncompletePacketError: 
-                    break
-                except (InvalidCrcError, ice):
-                    if error_callback: error_callback(ice) 
-                    if resync: i += 8
-                    else: i += (size * 8)
-            buf = buf[i:]
-            r = data.read(1024)
+        for packet in decoder.decode(data):
+            yield packet
     elif hasattr(data, 'recv'):
         data.setblocking(True)
         logger.debug('decoding packets from socket: %s', data)
-        buf = bitarray()  
-        r = data.recv(1024)
-        b = bitarray()
-        b.frombytes(r)
-        while len(r):
-            buf.frombytes(r)
-            logger.debug('chunking buffer of length %d bytes', len(buf)/8)
-            i = 0
-            while i < len(buf):
-                if len(buf) < 2: break
-                size = (int(buf[i:i+2].to01(), 2) + 1) * 24
-                if len(buf) < (size * 8): break
-                try:
-                    packet = Packet.frombits(buf, i=i, check_crc=check_crc)
-                    yield packet
-                    i += (size * 8)
-                except IncompletePacketError: break
-                except (InvalidCrcError, ice):
-                    if error_callback: error_callback(ice) 
-                    if resync: i += 8
-                    else: i += (size * 8)
-            buf = buf[i:]
-            logger.debug('reading from socket')
-            r = data.recv(1024)
-            logger.debug('read %d bytes from socket', len(r))            
+        for packet in decoder.decode(data):
+            yield packet
     else:
         raise ValueError('unknown object to decode from: %s' % type(data))
     logger.debug('finished')
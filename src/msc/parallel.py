@@ -0,0 +1,367 @@
+from msc.datagroups import ConstantSegmentSize, Datagroup, Segment, BODY, _headermode_datagroups, _encode_directory_entry, _encode_directory, _directory_datagroups, _continuity_padding
+from msc.datagroups import DatagroupReassembler, ReassemblyState
+from msc.packets import Packet, PacketDecoder, iter_packets
+from concurrent.futures import ProcessPoolExecutor
+import itertools
+import logging
+import mmap
+import os
+
+logger = logging.getLogger('msc.parallel')
+
+def _segment_sizes(data, strategy):
+    """sizes of the segments a strategy splits data into, without segmenting it"""
+    sizes = []
+    i = 0
+    while i < len(data):
+        size = strategy.get_next_segment_size(data, i, sizes)
+        sizes.append(min(size, len(data) - i))
+        i += size
+    return sizes
+
+def _encode_headermode(object, segmenting_strategy):
+    """
+    worker: (type, segment index, continuity, last, data, encoded) for the header mode datagroups
+    of an object, where the data of a body datagroup is the offset and size of its segment
+    """
+    datagroups = []
+    for d in _headermode_datagroups(object, segmenting_strategy):
+        segment = d.get_data()
+        data = (segment.offset, len(segment.view)) if d.get_type() == BODY else segment.tobytes()
+        datagroups.append((d.get_type(), d.segment_index, d.continuity, d.last, data, d.tobytes()))
+    return datagroups
+
+def _encode_bodies(object, sizes, continuity):
+    """
+    worker: directory entry and (type, segment index, continuity, last, data, encoded) for the
+    body datagroups of an object, segmented to the given sizes from the given continuity index
+    """
+    body = object.get_body()
+    datagroups = []
+    offset = 0
+    for i, size in enumerate(sizes):
+        datagroup = Datagroup(object.get_transport_id(), BODY, Segment(body, offset, size), i, continuity, last=i == len(sizes) - 1)
+        datagroups.append((BODY, i, continuity, datagroup.last, (offset, size), datagroup.tobytes()))
+        offset += size
+        continuity = (continuity + 1) % 16
+    return _encode_directory_entry(object), datagroups
+
+def _encode_packets(datagroups, address, size, index):
+    """worker: encoded packets for a run of encoded datagroups, following the given continuity index"""
+    return list(iter_packets(datagroups, address, size, {address: index}, raw=True))
+
+class ParallelEncoder:
+    """
+    Encodes sets of MOT objects across a pool of worker processes
+
+    Each object is segmented and its datagroups encoded in a worker. The encoded
+    bytes come back with the segment offsets, so the datagroups are made here over
+    views of the bodies, in the same order as encoding serially, with their encoded
+    bytes already cached. For directory mode the segment sizes are planned up front,
+    so that the continuity index each object starts from is known.
+    """
+
+    def __init__(self, workers=None, segmenting_strategy=None):
+        self.workers = workers or os.cpu_count() or 1
+        self.segmenting_strategy = segmenting_strategy or ConstantSegmentSize()
+        self.executor = ProcessPoolExecutor(self.workers)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.executor.shutdown()
+
+    def _chunksize(self, n):
+        return max(1, n // (self.workers * 4))
+
+    def _datagroups(self, object, encoded, cache):
+        """datagroups of an object from a worker, with the bytes encoded by the worker cached"""
+        datagroups = []
+        body = object.get_body()
+        for type, segment_index, continuity, last, data, encoded_bytes in encoded:
+            if type == BODY: data = Segment(body, *data)
+            datagroup = Datagroup(object.get_transport_id(), type, data, segment_index, continuity, last=last)
+            cache[datagroup._cache_key()] = encoded_bytes
+            datagroup.cache = cache
+            datagroups.append(datagroup)
+        return datagroups
+
+    def encode_headermode(self, objects):
+        """Encode a set of MOT objects into header mode datagroups"""
+
+        if not isinstance(objects, list): objects = [objects]
+        logger.debug('encoding %d MOT objects to header mode datagroups across %d workers', len(objects), self.workers)
+
+        datagroups = []
+        cache = {}
+        results = self.executor.map(_encode_headermode, objects, itertools.repeat(self.segmenting_strategy), chunksize=self._chunksize(len(objects)))
+        for object, encoded in zip(objects, results):
+            datagroups.extend(self._datagroups(object, encoded, cache))
+
+        return datagroups
+
+    def encode_directorymode(self, objects, directory_parameters=None, carousel_period=0, transport_id=None):
+        """Encode a set of MOT objects into directory mode datagroups, along with a segmented directory object"""
+
+        logger.debug('encoding %d MOT objects to directory mode datagroups across %d workers', len(objects), self.workers)
+
+        # plan the segments of the bodies to know the continuity index each object starts from
+        plans = []
+        starts = []
+        continuity_body = 0
+        for object in objects:
+            sizes = _segment_sizes(object.get_body(), self.segmenting_strategy)
+            plans.append(sizes)
+            starts.append(continuity_body)
+            continuity_body = (continuity_body + len(sizes)) % 16
+        results = list(self.executor.map(_encode_bodies, objects, plans, starts, chunksize=self._chunksize(len(objects))))
+
+        # directory from the entries encoded by the workers
+        entries = b''.join([entry for entry, _ in results])
+        datagroups = _directory_datagroups(_encode_directory(entries, len(objects), directory_parameters, carousel_period), self.segmenting_strategy, transport_id)
+
+        cache = {}
+        for object, (_, encoded) in zip(objects, results):
+            datagroups.extend(self._datagroups(object, encoded, cache))
+
+        # add empty body datagroups to assure continuity
+        datagroups.extend(_continuity_padding(continuity_body, transport_id))
+
+        return datagroups
+
+    def encode_packets(self, datagroups, address=None, size=None, continuity=None):
+        """
+        Encode a set of datagroups into packets, returning the encoded bytes of each packet
+
+        The datagroups are split into a run for each worker, with the continuity index
+        each run starts from counted from the number of packets before it.
+        """
+
+        if not address: address = 1
+        if not size: size = Packet.SIZE_96
+        if continuity is None: continuity = {}
+
+        encoded = [datagroup if isinstance(datagroup, bytes) else datagroup.tobytes() for datagroup in datagroups]
+        chunk_size = size - 5
+        run = max(1, -(-len(encoded) // self.workers))
+        runs = []
+        starts = []
+        index = continuity.get(address, -1)
+        for i in range(0, len(encoded), run):
+            runs.append(encoded[i:i+run])
+            starts.append(index)
+            index = (index + sum((len(data) + chunk_size - 1) // chunk_size for data in runs[-1])) % 4
+        results = self.executor.map(_encode_packets, runs, itertools.repeat(address), itertools.repeat(size), starts)
+        packets = list(itertools.chain.from_iterable(results))
+        if packets: continuity[address] = index
+
+        return packets
+
+def _decode_chunk(filename, start, end, check_crc, addresses, lock_threshold):
+    """
+    worker: packets decoded from a chunk of a capture, as (offset, packet), along
+    with the error counters for the chunk
+
+    Chunks after the first are not known to start on a packet boundary, so the
+    decoder scans for valid packets to lock onto first. Decoding runs on past the
+    end of the chunk, so that the packets up to where the next chunk locks on are
+    decoded while still locked. The decoder is mapped onto the chunk rather than
+    fed a copy of it, with only the data of each packet copied out of the capture.
+    """
+    packets = []
+    counters = None
+    with open(filename, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as capture:
+            stop = min(len(capture), end + Packet.SIZE_96 * (lock_threshold + 1))
+            view = memoryview(capture)[start:stop]
+            decoder = PacketDecoder(check_crc=check_crc, addresses=addresses, lock_threshold=lock_threshold, locked=start == 0, buffer_size=0)
+            decoder.map(view)
+            decoder._closed = stop == len(capture) # the capture carries on past the run on
+
+            # counters up to the end of the chunk, as the next chunk counts any errors after it
+            for packet in decoder:
+                offset = start + decoder.tell() - packet.size
+                if offset >= end and counters is None: counters = (decoder.crc_errors, decoder.bytes_skipped, decoder.resyncs)
+                packet.data = packet.data.tobytes()
+                packets.append((offset, packet))
+            decoder._buf.release()
+            view.release()
+
+    if counters is None: counters = (decoder.crc_errors, decoder.bytes_skipped, decoder.resyncs)
+    crc_errors, bytes_skipped, resyncs = counters
+
+    # discount locking onto the first packet, which is not a loss of lock
+    if start and packets:
+        bytes_skipped -= packets[0][0] - start
+        resyncs -= 1
+    return packets, crc_errors, bytes_skipped, resyncs
+
+def _reassemble_chunk(filename, start, end, check_crc, addresses, lock_threshold):
+    """
+    worker: (offset, address, datagroup) for each datagroup started and completed within
+    a chunk of a capture, by the offset of the packet completing it, along with what is
+    needed to reassemble those spanning the edges of the chunk
+
+    These are the offset the chunk locked on at, the packets on each address before a
+    datagroup first starts, the continuity index each first starts at, the packets of
+    any datagroups still in progress at the end, and the packets decoded on past the
+    end. The reassembly states returned leave out the packets still in progress, and
+    the error counters are those of decoding the chunk.
+    """
+    packets, crc_errors, bytes_skipped, resyncs = _decode_chunk(filename, start, end, check_crc, addresses, lock_threshold)
+    reassembler = DatagroupReassembler(check_crc=check_crc)
+    datagroups = []
+    head = []
+    started = {}
+    current = {} # packets of the datagroup in progress on each address
+    for offset, packet in packets:
+        if offset >= end: break
+        address = packet.address
+        if packet.first and len(packet.data):
+            if address not in started: started[address] = packet.index
+            current[address] = []
+        elif address not in started:
+            head.append((offset, packet))
+            continue
+        current[address].append((offset, packet))
+        datagroup = reassembler.push(packet)
+        if datagroup is not None:
+            datagroup._data = bytes(datagroup._data)
+            datagroups.append((offset, address, datagroup))
+
+    tail = []
+    for address, state in reassembler.states.items():
+        if state.buf is None: continue
+        tail.extend(current[address])
+        state.packets -= len(current[address])
+        state.buf = None
+    tail.sort(key=lambda x: x[0])
+    lock = packets[0][0] if packets else None
+    runon = [(offset, packet) for offset, packet in packets if offset >= end]
+    return datagroups, lock, head, started, tail, runon, reassembler.states, crc_errors, bytes_skipped, resyncs
+
+class ParallelDecoder:
+    """
+    Decodes a packet capture file across a pool of worker processes
+
+    The capture is memory mapped and split into chunks, with each worker decoding
+    and checking the CRCs of the packets that start within its chunk. Datagroups
+    are reassembled in the same worker, so that only those spanning the edges of
+    a chunk are reassembled here from the packets either side. Packets and
+    datagroups are yielded in the order they appear in the capture, as each
+    chunk is decoded.
+
+    Error counters are kept on the decoder as a capture is decoded, with the
+    reassembly state for each address once it has been decoded to the end.
+    """
+
+    def __init__(self, workers=None, check_crc=True, addresses=None, chunk_size=1 << 24, lock_threshold=3):
+        """
+        workers: number of worker processes, by default one for each CPU
+        check_crc: check the CRC of each packet and datagroup
+        addresses: packet addresses to decode, packets for any others are skipped
+        chunk_size: number of bytes of the capture to decode in each task
+        lock_threshold: number of consecutive valid packets needed to lock onto a chunk
+        """
+        self.workers = workers or os.cpu_count() or 1
+        self.check_crc = check_crc
+        self.addresses = frozenset(addresses) if addresses is not None else None
+        self.chunk_size = max(chunk_size, Packet.SIZE_96 * (lock_threshold + 1))
+        self.lock_threshold = lock_threshold
+        self.crc_errors = 0
+        self.bytes_skipped = 0
+        self.resyncs = 0
+        self.states = {}
+
+    def _filename(self, capture):
+        return capture if isinstance(capture, str) else capture.name
+
+    def decode_packets(self, capture):
+        """
+        Generator function yielding the packets in a capture, given as a filename or
+        file object, as (offset, packet) in the order they appear
+        """
+        filename = self._filename(capture)
+        size = os.path.getsize(filename)
+        starts = list(range(0, size, self.chunk_size))
+        logger.debug('decoding %d bytes of packets from %s in %d chunks across %d workers', size, filename, len(starts), self.workers)
+
+        previous = 0
+        self.crc_errors = self.bytes_skipped = self.resyncs = 0
+        with ProcessPoolExecutor(self.workers) as executor:
+            results = executor.map(_decode_chunk, itertools.repeat(filename), starts, [start + self.chunk_size for start in starts],
+                                   itertools.repeat(self.check_crc), itertools.repeat(self.addresses), itertools.repeat(self.lock_threshold))
+            for chunk, crc_errors, bytes_skipped, resyncs in results:
+                # keep to the packets decoded by the chunk before, up to where it stopped
+                chunk = [(offset, packet) for offset, packet in chunk if offset >= previous]
+                if chunk: previous = chunk[-1][0] + chunk[-1][1].size
+                self.crc_errors += crc_errors
+                self.bytes_skipped += bytes_skipped
+                self.resyncs += resyncs
+                yield from chunk
+
+    def decode_datagroups(self, capture):
+        """
+        Generator function yielding the datagroups in a capture, given as a filename or
+        file object, as (address, datagroup) in the order they complete
+        """
+        filename = self._filename(capture)
+        size = os.path.getsize(filename)
+        starts = list(range(0, size, self.chunk_size))
+        logger.debug('decoding %d bytes of datagroups from %s in %d chunks across %d workers', size, filename, len(starts), self.workers)
+
+        reassembler = DatagroupReassembler(check_crc=self.check_crc)
+        states = []
+        runon = []
+        self.crc_errors = self.bytes_skipped = self.resyncs = 0
+        with ProcessPoolExecutor(self.workers) as executor:
+            results = executor.map(_reassemble_chunk, itertools.repeat(filename), starts, [start + self.chunk_size for start in starts],
+                                   itertools.repeat(self.check_crc), itertools.repeat(self.addresses), itertools.repeat(self.lock_threshold))
+            for chunk, lock, head, started, tail, next_runon, chunk_states, crc_errors, bytes_skipped, resyncs in results:
+                # packets the chunk before decoded on past its end, up to where this one locked on,
+                # followed by those on each address before a datagroup first starts in this one
+                datagroups = []
+                for offset, packet in [(offset, packet) for offset, packet in runon if lock is None or offset < lock] + head:
+                    datagroup = reassembler.push(packet)
+                    if datagroup is not None: datagroups.append((offset, packet.address, datagroup))
+
+                # the first datagroup started in the chunk follows on from those packets
+                for address, index in started.items():
+                    state = reassembler.states.get(address)
+                    if state is None: continue
+                    if state.index is not None and index != (state.index + 1) % 4:
+                        state.continuity_errors += 1
+                        reassembler.metrics.increment('datagroups.continuity_errors', address=address)
+                    if state.buf is not None: reassembler._abandon(state, 'new datagroup started on address %d' % address)
+                    state.index = None
+
+                # and the datagroups in progress at its end carry on into the next, with the
+                # continuity of each address following on from its last packet in the chunk
+                for offset, packet in tail: reassembler.push(packet)
+                for address in started:
+                    state = reassembler.states.get(address)
+                    if state is None: state = reassembler.states[address] = ReassemblyState(address)
+                    state.index = chunk_states[address].index
+                runon = next_runon
+                states.append(chunk_states)
+                self.crc_errors += crc_errors
+                self.bytes_skipped += bytes_skipped
+                self.resyncs += resyncs
+
+                # nothing completed later can complete before the end of the chunk
+                datagroups.extend(chunk)
+                datagroups.sort(key=lambda x: x[0])
+                for offset, address, datagroup in datagroups: yield address, datagroup
+        states.append(reassembler.states)
+
+        self.states = {}
+        for chunk_states in states:
+            for address, state in chunk_states.items():
+                total = self.states.get(address)
+                if total is None: total = self.states[address] = ReassemblyState(address)
+                for counter in ('packets', 'datagroups', 'crc_errors', 'continuity_errors', 'incomplete'):
+                    setattr(total, counter, getattr(total, counter) + getattr(state, counter))
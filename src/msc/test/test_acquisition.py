@@ -0,0 +1,59 @@
+import unittest
+from mot import MotObject, ContentType
+from msc import transport_id_generator
+from msc.acquisition import AcquisitionSimulator, acquisition_times, DIRECTORY
+from msc.datagroups import encode_directorymode, encode_headermode, CarouselScheduler, DirectoryDatagroupEncoder
+
+class Test(unittest.TestCase):
+
+    def setUp(self):
+        self.objects = [MotObject("TestObject%d" % i, bytes([i]) * (3000 * i + 500), ContentType.IMAGE_JFIF) for i in range(4)]
+
+    def test_analyse(self):
+        """testing the exact acquisition times agree with simulated receivers"""
+        simulator = AcquisitionSimulator(encode_directorymode(self.objects), 16000)
+        analysed = simulator.analyse()
+        simulated = simulator.simulate(trials=5000, seed=1)
+        self.assertEqual(set(analysed), set([DIRECTORY] + [o.get_transport_id() for o in self.objects]))
+        for key in analysed:
+            expected, worst = analysed[key]
+            self.assertLessEqual(expected, worst)
+            self.assertLessEqual(worst, 2 * simulator.cycle_time)
+            self.assertAlmostEqual(simulated[key][0], expected, delta=0.05 * expected)
+            self.assertLessEqual(simulated[key][1], worst + 1e-9)
+
+    def test_analyse_repeated(self):
+        """testing the exact acquisition times agree with simulated receivers with objects repeated through the cycle"""
+        scheduler = CarouselScheduler(16000, directory_interval=2)
+        scheduler.set_object(self.objects[0], repetition=3)
+        encoder = DirectoryDatagroupEncoder(scheduler=scheduler)
+        encoder.set(self.objects)
+        simulator = AcquisitionSimulator(encoder.datagroups, 16000)
+        analysed = simulator.analyse()
+        simulated = simulator.simulate(trials=5000, seed=1)
+        for key in analysed:
+            self.assertAlmostEqual(simulated[key][0], analysed[key][0], delta=0.05 * analysed[key][0])
+            self.assertLessEqual(simulated[key][1], analysed[key][1] + 1e-9)
+        self.assertLess(analysed[self.objects[0].get_transport_id()][0], analysed[self.objects[1].get_transport_id()][0])
+
+    def test_directory(self):
+        """testing objects in directory mode wait for the directory"""
+        times = acquisition_times(self.objects, 16000)
+        for o in self.objects: self.assertGreaterEqual(times[o.get_transport_id()][0], times[DIRECTORY][0])
+        times = acquisition_times(self.objects, 16000, directory=False)
+        self.assertNotIn(DIRECTORY, times)
+
+    def test_transport_ids(self):
+        """testing simulating a carousel takes no transport IDs from the generator"""
+        used = len(transport_id_generator.ids)
+        for i in range(10): acquisition_times(self.objects, 16000)
+        self.assertEqual(len(transport_id_generator.ids), used)
+
+    def test_loss(self):
+        """testing packet loss lengthens acquisition"""
+        lossless = acquisition_times(self.objects, 16000)
+        lossy = acquisition_times(self.objects, 16000, loss=0.05, trials=500, seed=1)
+        for key in lossless: self.assertGreater(lossy[key][0], lossless[key][0])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,48 @@
+import os
+import tempfile
+import unittest
+from mot import MotObject, ContentType
+from msc.capture import CaptureRenderer, read_capture, DATAGROUP, PACKET
+from msc.datagroups import DirectoryDatagroupEncoder, Datagroup
+from msc.packets import iter_packets, Packet
+
+class Test(unittest.TestCase):
+
+    def setUp(self):
+        self.encoder = DirectoryDatagroupEncoder()
+        self.encoder.set([MotObject("TestObject%d" % i, bytes([i]) * 3000, ContentType.IMAGE_JFIF) for i in range(4)])
+        f = tempfile.NamedTemporaryFile(suffix='.cap', delete=False)
+        f.close()
+        self.path = f.name
+        self.addCleanup(os.remove, self.path)
+
+    def test_packets(self):
+        """testing packets are rendered into 24ms slots for the given output time"""
+        renderer = CaptureRenderer(self.path)
+        records = renderer.render(iter_packets(self.encoder, 1, 96), 60)
+        self.assertEqual(records, 2500)
+
+        with open(self.path, 'rb') as f:
+            captured = list(read_capture(f))
+            self.assertEqual(len(captured), records)
+            self.assertEqual(set(kind for t, kind, data in captured), set([PACKET]))
+            self.assertAlmostEqual(captured[-1][0], 59.976)
+            packets = [Packet.frombytes(data) for t, kind, data in captured]
+            self.assertEqual([p.index for p in packets], [i % 4 for i in range(records)])
+            del captured, packets
+
+    def test_datagroups(self):
+        """testing datagroups are stamped with the time to send those before them at the bitrate"""
+        renderer = CaptureRenderer(self.path, bitrate=8192)
+        renderer.render(self.encoder.datagroups)
+
+        with open(self.path, 'rb') as f:
+            captured = list(read_capture(f.read()))
+        self.assertEqual([bytes(data) for t, kind, data in captured], [d.tobytes() for d in self.encoder.datagroups])
+        times = [t for t, kind, data in captured]
+        for (t, kind, data), next in zip(captured, times[1:]):
+            self.assertEqual(kind, DATAGROUP)
+            self.assertAlmostEqual(next - t, 8.0 * len(data) / 8192, places=5)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,5 +1,8 @@
 from msc import calculate_crc
+from msc.crc import Crc, verify_packets
+from msc.packets import Packet
 import unittest
+import unittest.mock
 
 class Test(unittest.TestCase):
 
@@ -11,5 +14,26 @@ class Test(unittest.TestCase):
         """
         assert(calculate_crc("123456789") == 0x906e)
 
+    def test_incremental_crc(self):
+        """CRC accumulated in chunks matches the CRC over the joined data"""
+        data = bytes(range(256)) * 4
+        crc = Crc()
+        for i in range(0, len(data), 91):
+            crc.update(data[i:i+91])
+        self.assertEqual(crc.value, calculate_crc(data))
+        self.assertEqual(Crc(b"123456789"), 0xd64e)
+
+    def test_verify_packets(self):
+        """batch verification flags only the corrupted packets"""
+        packets = [Packet(Packet.SIZE_96, 1, bytes([i]) * 91, True, True, i % 4).tobytes() for i in range(10)]
+        buf = bytearray(b"".join(packets))
+        buf[3 * 96 + 50] ^= 0x01
+        buf[7 * 96 + 95] ^= 0x80
+        mask = verify_packets(buf, Packet.SIZE_96)
+        self.assertIsInstance(mask, list)
+        self.assertEqual(mask, [True, True, True, False, True, True, True, False, True, True])
+        with unittest.mock.patch('msc.crc.numpy', None):
+            self.assertEqual(verify_packets(buf, Packet.SIZE_96), mask)
+
 if __name__ == "__main__":
     unittest.main()
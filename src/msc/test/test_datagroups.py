@@ -1,9 +1,32 @@
+import io
+import itertools
 import unittest
-from mot import MotObject, ContentType
-from msc import bitarray_to_hex
-from msc.datagroups import encode_headermode, encode_directorymode 
+from mot import MotObject, ContentType, SortedHeaderInformation
+from msc import bitarray_to_hex, int_to_bitarray, calculate_crc, InvalidCrcError
+from msc.datagroups import encode_headermode, encode_directorymode, decode_datagroups, Datagroup, DatagroupFramer, DatagroupReassembler, DirectoryDatagroupEncoder, CarouselScheduler
+from msc.packets import encode_packets, decode_packets
 from bitarray import bitarray
 
+def reference_tobytes(datagroup):
+    """bit-by-bit reference encoding of a datagroup"""
+    bits = bitarray()
+    bits += bitarray('0')
+    bits += bitarray('1' if datagroup.crc_enabled else '0')
+    bits += bitarray('11')
+    bits += int_to_bitarray(datagroup.get_type(), 4)
+    bits += int_to_bitarray(datagroup.continuity % 16, 4)
+    bits += int_to_bitarray(datagroup.repetition, 4)
+    bits += bitarray('1' if datagroup.last else '0')
+    bits += int_to_bitarray(datagroup.segment_index, 15)
+    bits += bitarray('0001')
+    bits += int_to_bitarray(2, 4)
+    bits += int_to_bitarray(datagroup.get_transport_id(), 16)
+    tmp = bitarray()
+    tmp.frombytes(bytes(datagroup.get_data()))
+    bits += tmp
+    bits += int_to_bitarray(calculate_crc(bits.tobytes()) if datagroup.crc_enabled else 0, 16)
+    return bits.tobytes()
+
 class Test(unittest.TestCase):
 
     def test_blank_headermode(self):
@@ -38,5 +61,230 @@ class Test(unittest.TestCase):
             tmp.frombytes(datagroup.tobytes())
             # TODO test bytes
 
+    def test_tobytes_equivalence(self):
+        """testing byte encoder against the bitwise reference encoding"""
+
+        for transport_id, type, size, segment_index, continuity, repetition, last, crc in [
+                (0, 3, 0, 0, 0, 0, False, True),
+                (1, 4, 1, 1, 15, 3, True, True),
+                (12345, 6, 100, 32767, 16, 0, False, False),
+                (65535, 7, 8191, 500, 7, 15, True, True)]:
+            data = bytes(range(256)) * (size // 256) + bytes(range(size % 256))
+            datagroup = Datagroup(transport_id, type, data, segment_index, continuity, crc, repetition, last)
+            self.assertEqual(datagroup.tobytes(), reference_tobytes(datagroup))
+
+    def test_tobytes_roundtrip(self):
+        """testing encoded datagroups parse back to the same fields"""
+
+        object = MotObject("TestObject", b"\x01" * 20000, ContentType.IMAGE_JFIF)
+        for datagroup in encode_headermode([object]):
+            bits = bitarray()
+            bits.frombytes(datagroup.tobytes())
+            decoded = Datagroup.frombits(bits)
+            self.assertEqual(decoded, datagroup)
+            self.assertEqual(decoded.continuity, datagroup.continuity)
+            self.assertEqual(decoded.last, datagroup.last)
+            self.assertEqual(decoded.get_data(), datagroup.get_data()[2:])
+
+    def test_frombytes_offset(self):
+        """testing parsing from a byte offset returns a view onto the buffer"""
+
+        datagroup = Datagroup(1234, 4, b"\x00\x05hello", 3, 9, last=True)
+        buf = b"\xff" * 5 + datagroup.tobytes() + b"\xff" * 3
+
+        decoded = Datagroup.frombytes(buf, 5)
+        self.assertIsInstance(decoded.get_data(), memoryview)
+        self.assertEqual(decoded.get_data(), b"hello")
+        self.assertEqual(decoded.get_transport_id(), 1234)
+        self.assertEqual(decoded.segment_index, 3)
+        self.assertEqual(decoded.continuity, 9)
+        self.assertTrue(decoded.last)
+        self.assertEqual(decoded.size, len(datagroup.tobytes()))
+
+        bits = bitarray()
+        bits.frombytes(buf)
+        self.assertEqual(Datagroup.frombits(bits, i=40).get_data(), b"hello")
+
+    def test_frombytes_invalid_crc(self):
+        """testing a corrupted datagroup fails the CRC check"""
+
+        buf = bytearray(Datagroup(1, 4, b"\x00\x01x", 0, 0).tobytes())
+        buf[-1] ^= 0xff
+        self.assertRaises(InvalidCrcError, Datagroup.frombytes, buf)
+        self.assertEqual(Datagroup.frombytes(buf, check_crc=False).get_data(), b"x")
+
+    def test_framer_chunks(self):
+        """testing datagroups are framed across arbitrary chunk boundaries"""
+
+        datagroups = [Datagroup(i, 4, bytes([0, i]) + bytes([i]) * i, i, i % 16) for i in range(50)]
+        data = b"".join(datagroup.tobytes() for datagroup in datagroups)
+
+        framer = DatagroupFramer()
+        decoded = []
+        for i in range(0, len(data), 13):
+            framer.feed(data[i:i+13])
+            decoded.extend(framer)
+        self.assertEqual(decoded, datagroups)
+        self.assertEqual([d.get_data() for d in decoded], [d.get_data()[2:] for d in datagroups])
+
+    def test_framer_resync_at_end(self):
+        """testing datagroups after a corrupted length near the end of the bitstream are still framed"""
+
+        datagroups = [Datagroup(i, 4, bytes([0, 20]) + bytes([i]) * 20, i, i) for i in range(6)]
+        encoded = [bytearray(d.tobytes()) for d in datagroups]
+        encoded[3][-1] ^= 0xff # CRC error
+        garbage = bytes([0x70, 0x00, 0x00, 0x00, 0x12, 0x00, 0x01, 0x1f, 0xff, 0x00, 0x00]) # claims an 8191 byte segment
+        data = b"".join(encoded[:4]) + garbage + b"".join(encoded[4:])
+
+        for decoded in (list(decode_datagroups(data)), list(decode_datagroups(io.BytesIO(data)))):
+            self.assertEqual(decoded, datagroups[:3] + datagroups[4:])
+
+    def test_decode_buffer(self):
+        """testing decoding datagroups from a buffer without copying"""
+
+        datagroups = encode_directorymode([MotObject("TestObject", b"\x00" * 20000, ContentType.IMAGE_JFIF)])
+        data = bytearray(b"".join(d.tobytes() for d in datagroups))
+        decoded = list(decode_datagroups(data))
+        self.assertEqual([d.get_data() for d in decoded], [d.get_data()[2:] for d in datagroups])
+        self.assertIs(decoded[0].get_data().obj, data)
+
+    def test_frombytes_no_transport_id(self):
+        """testing a datagroup without segment or user access fields parses and prints"""
+
+        buf = bytes([0x44, 0x00, 0x00, 0x05]) + b"hello"
+        buf += calculate_crc(buf).to_bytes(2, 'big')
+        decoded = Datagroup.frombytes(buf)
+        self.assertIsNone(decoded.get_transport_id())
+        self.assertEqual(decoded.get_data(), b"hello")
+        self.assertIn("transportid=None", str(decoded))
+
+    def test_framer_extension_field(self):
+        """testing the header length follows the extension flag"""
+
+        encoded = Datagroup(99, 4, b"\x00\x03abc", 0, 0).tobytes()
+        extended = bytes([encoded[0] | 0x80, encoded[1], 0x12, 0x34]) + encoded[2:-2]
+        extended += calculate_crc(extended).to_bytes(2, 'big')
+
+        decoded = list(decode_datagroups(io.BytesIO(extended + encoded)))
+        self.assertEqual(len(decoded), 2)
+        self.assertEqual(decoded[0].get_transport_id(), 99)
+        self.assertEqual(decoded[0].get_data(), b"abc")
+        self.assertEqual(decoded[0].size, len(extended))
+
+    def test_reassembler_addresses(self):
+        """testing interleaved packet addresses reassemble independently"""
+
+        first = [Datagroup(1, 4, bytes([0, 200]) + bytes([i]) * 200, i, i) for i in range(5)]
+        second = [Datagroup(2, 4, bytes([0, 100]) + bytes([i]) * 100, i, i) for i in range(5)]
+        packets = [p for pair in itertools.zip_longest(encode_packets(first, 10), encode_packets(second, 20)) for p in pair if p]
+
+        reassembler = DatagroupReassembler()
+        decoded = list(reassembler.reassemble(packets))
+        self.assertEqual([d for a, d in decoded if a == 10], first)
+        self.assertEqual([d for a, d in decoded if a == 20], second)
+        self.assertEqual(reassembler.states[10].datagroups, 5)
+        self.assertEqual(reassembler.states[20].crc_errors, 0)
+
+        reassembler = DatagroupReassembler(addresses=[20])
+        decoded = list(reassembler.reassemble(packets))
+        self.assertEqual([d for a, d in decoded], second)
+        self.assertNotIn(10, reassembler.states)
+
+    def test_reassembler_continuity(self):
+        """testing a missing packet loses only its own datagroup"""
+
+        datagroups = [Datagroup(1, 4, bytes([0, 150]) + bytes([i]) * 150, i, i) for i in range(3)]
+        packets = encode_packets(datagroups, 10)
+        del packets[1]
+
+        reassembler = DatagroupReassembler()
+        decoded = [d for a, d in reassembler.reassemble(packets)]
+        self.assertEqual(decoded, datagroups[1:])
+        self.assertEqual(reassembler.states[10].continuity_errors, 1)
+        self.assertEqual(reassembler.states[10].incomplete, 1)
+
+    def test_carousel_cache(self):
+        """testing the carousel encodes each datagroup once until it regenerates"""
+
+        encoder = DirectoryDatagroupEncoder()
+        encoder.add(MotObject("TestObject", b"\x00" * 20000, ContentType.IMAGE_JFIF))
+        n = len(encoder.datagroups)
+
+        first = [next(encoder).tobytes() for i in range(n)]
+        second = [next(encoder).tobytes() for i in range(n)]
+        self.assertEqual(len(encoder.cache), n)
+        for a, b in zip(first, second):
+            self.assertIs(a, b)
+
+        encoder.add(MotObject("TestObject2", b"\x00" * 1000, ContentType.IMAGE_JFIF))
+        self.assertLess(len(encoder.cache), n)
+        self.assertEqual(encoder.packet_cache, {})
+
+    def test_carousel_packet_cache(self):
+        """testing cached carousel packets keep continuity across cycles"""
+
+        encoder = DirectoryDatagroupEncoder()
+        encoder.add(MotObject("TestObject", b"\x00" * 1000, ContentType.IMAGE_JFIF))
+
+        data = b"".join(itertools.islice(encoder.packets(5), 200))
+        indices = [p.index for p in decode_packets(io.BytesIO(data))]
+        self.assertEqual(len(indices), 200)
+        self.assertEqual(indices, [i % 4 for i in range(200)])
+
+    def test_carousel_incremental(self):
+        """testing only changed objects are encoded again when the carousel regenerates"""
+
+        objects = [MotObject("TestObject%d" % i, bytes([i]) * 10000, ContentType.IMAGE_JFIF) for i in range(3)]
+        encoder = DirectoryDatagroupEncoder()
+        encoder.set(list(objects))
+        bodies = dict((d.get_transport_id(), d) for d in encoder.datagroups if d.get_type() == 4 and d.segment_index == 0)
+        previous = encoder.datagroups
+        continuity = [d.continuity for d in previous]
+
+        objects[1].set_body(b"\xff" * 20000)
+        encoder.regenerate()
+        self.assertEqual([d.continuity for d in previous], continuity) # previous cycle is left alone
+        regenerated = dict((d.get_transport_id(), d) for d in encoder.datagroups if d.get_type() == 4 and d.segment_index == 0)
+        self.assertIs(regenerated[objects[0].get_transport_id()], bodies[objects[0].get_transport_id()])
+        self.assertIsNot(regenerated[objects[1].get_transport_id()], bodies[objects[1].get_transport_id()])
+
+        # continuity runs on through the bodies as if encoded from scratch
+        expected = encode_directorymode(objects, directory_parameters=[SortedHeaderInformation()])
+        transport_ids = [o.get_transport_id() for o in objects]
+        self.assertEqual([(d.get_transport_id(), d.segment_index, d.continuity) for d in encoder.datagroups if d.get_transport_id() in transport_ids],
+                         [(d.get_transport_id(), d.segment_index, d.continuity) for d in expected if d.get_transport_id() in transport_ids])
+        self.assertEqual([bytes(d.get_data()) for d in encoder.datagroups if d.get_type() == 6],
+                         [bytes(d.get_data()) for d in expected if d.get_type() == 6])
+
+    def test_carousel_scheduler(self):
+        """testing a scheduled carousel repeats objects and the directory, and signals its period"""
+
+        objects = [MotObject("TestObject%d" % i, bytes([i]) * 500, ContentType.IMAGE_PNG) for i in range(3)]
+        objects.append(MotObject("TestImage", b"\xff" * 40000, ContentType.IMAGE_JFIF))
+        scheduler = CarouselScheduler(16000, directory_interval=5)
+        scheduler.set_object(objects[0], repetition=3, priority=1)
+        encoder = DirectoryDatagroupEncoder(scheduler=scheduler)
+        encoder.set(objects)
+
+        bodies = [d for d in encoder.datagroups if d.get_type() == 4]
+        directories = [d for d in encoder.datagroups if d.get_type() == 6]
+        self.assertIs(encoder.datagroups[0], directories[0])
+        self.assertEqual(len([d for d in bodies if d.get_transport_id() == objects[0].get_transport_id()]), 3)
+        self.assertEqual(len([d for d in bodies if d.get_transport_id() == objects[3].get_transport_id()]), 5)
+        self.assertEqual([d.continuity for d in bodies], [i % 16 for i in range(len(bodies) - 1)] + [15])
+        self.assertGreater(len(directories), 1)
+        self.assertEqual([d.continuity for d in directories], [i % 16 for i in range(len(directories))])
+
+        # the encoded object datagroups are left alone for the next cycle
+        for object in objects:
+            self.assertTrue(all(d.continuity == 0 for d in encoder.encoded[object.get_transport_id()].datagroups))
+
+        # carousel period in tenths of seconds follows the segment header and directory size and number of objects
+        self.assertAlmostEqual(scheduler.cycle_time, scheduler.duration(encoder.datagroups))
+        period = int.from_bytes(bytes(directories[0].get_data()[8:11]), 'big')
+        self.assertEqual(period, scheduler.carousel_period())
+        self.assertGreater(period, 0)
+        self.assertTrue(all(bytes(d.get_data()) == bytes(directories[0].get_data()) for d in directories))
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,101 @@
+import io
+import unittest
+from mot import MotObject, ContentType
+from msc import metrics
+from msc.metrics import MemoryMetrics, Metrics, Histogram
+from msc.datagroups import DirectoryDatagroupEncoder, encode_headermode, decode_datagroups
+from msc.packets import encode_packets, decode_packets
+from msc.transports import BufferedFileTransport
+
+class Test(unittest.TestCase):
+
+    def setUp(self):
+        self.objects = [MotObject("TestObject%d" % i, bytes([i]) * 3000, ContentType.IMAGE_JFIF) for i in range(3)]
+
+    def test_histogram(self):
+        """testing histograms count observations into buckets"""
+        histogram = Histogram([1, 2, 4])
+        for value in [0.5, 1.5, 1.5, 3, 10]: histogram.observe(value)
+        self.assertEqual(histogram.counts, [1, 2, 1, 1])
+        self.assertEqual((histogram.count, histogram.min, histogram.max), (5, 0.5, 10))
+        self.assertEqual(histogram.quantile(0.5), 2)
+        self.assertEqual(histogram.quantile(1), 10)
+
+    def test_buckets(self):
+        """testing metrics in bytes get byte sized buckets unless given others"""
+        m = MemoryMetrics({'carousel.cycle_bytes': [1000]})
+        for name in ('packets.bytes_to_lock', 'carousel.cycle_bytes', 'transport.drift'): m.observe(name, 500)
+        self.assertEqual(m.histogram('packets.bytes_to_lock').buckets, Histogram.BYTE_BUCKETS)
+        self.assertEqual(m.histogram('packets.bytes_to_lock').counts[:3], [0, 0, 1])
+        self.assertEqual(m.histogram('carousel.cycle_bytes').buckets, (1000,))
+        self.assertEqual(m.histogram('transport.drift').buckets, Histogram.BUCKETS)
+
+    def test_counters(self):
+        """testing counters are kept by labels, and summed over labels not given"""
+        m = MemoryMetrics()
+        m.increment('packets', address=1)
+        m.increment('packets', 2, address=2)
+        self.assertEqual(m.counter('packets'), 3)
+        self.assertEqual(m.counter('packets', address=2), 2)
+        self.assertEqual(m.snapshot(), {'packets{address=1}': 1, 'packets{address=2}': 2})
+
+    def test_decode(self):
+        """testing packets, datagroups and CRC errors are counted when decoding"""
+        m = MemoryMetrics()
+        packets = encode_packets(encode_headermode(self.objects), address=5, metrics=m)
+        self.assertEqual(m.counter('packets.encoded', address=5), len(packets))
+
+        data = bytearray(b''.join(p.tobytes() for p in packets))
+        data[96 * 10 + 5] ^= 0xff # corrupt a packet
+        decoded = list(decode_datagroups(decode_packets(bytes(data), metrics=m), metrics=m))
+        self.assertEqual(m.counter('packets.crc_errors'), 1)
+        self.assertEqual(m.counter('packets.decoded', address=5), len(packets) - 1)
+        self.assertEqual(m.counter('datagroups.decoded'), len(decoded))
+        self.assertEqual(m.counter('datagroups.continuity_errors', address=5), 1)
+
+    def test_resync(self):
+        """testing bytes skipped resynchronising onto datagroups are counted once lock is regained"""
+        class CountingMetrics(MemoryMetrics):
+            calls = 0
+            def increment(self, name, value=1, **labels):
+                if name == 'datagroups.bytes_skipped': self.calls += 1
+                MemoryMetrics.increment(self, name, value, **labels)
+        m = CountingMetrics()
+        datagroups = [d.tobytes() for d in encode_headermode(self.objects)]
+        data = b''.join(datagroups[:2]) + b'\xff' * 30 + b''.join(datagroups[2:])
+        self.assertEqual(len(list(decode_datagroups(data, metrics=m))), len(datagroups))
+        self.assertEqual(m.counter('datagroups.bytes_skipped'), 30)
+        self.assertEqual(m.calls, 1)
+
+    def test_encoder(self):
+        """testing carousel regenerations are counted"""
+        m = MemoryMetrics()
+        encoder = DirectoryDatagroupEncoder(metrics=m)
+        encoder.set(self.objects)
+        encoder.add(MotObject("TestObject3", b'\x03' * 3000, ContentType.IMAGE_JFIF))
+        self.assertEqual(m.counter('carousel.regenerations'), 3)
+        self.assertEqual(m.counter('carousel.objects_encoded'), 4)
+        self.assertEqual(m.histogram('carousel.cycle_bytes').max, sum(len(d.tobytes()) for d in encoder.datagroups))
+
+    def test_transport(self):
+        """testing bytes written by a transport are counted"""
+        m = MemoryMetrics()
+        transport = BufferedFileTransport(io.BytesIO(), metrics=m)
+        for d in encode_headermode(self.objects): transport.add(d)
+        self.assertEqual(m.counter('transport.bytes_sent', transport='file'), transport.bytes_written)
+
+    def test_default(self):
+        """testing nothing is recorded by default, and the default can be set"""
+        self.assertIsInstance(metrics.get_metrics(), Metrics)
+        self.assertFalse(metrics.get_metrics().enabled)
+        m = MemoryMetrics()
+        metrics.set_metrics(m)
+        try:
+            list(decode_packets(b''.join(p.tobytes() for p in encode_packets(encode_headermode(self.objects)))))
+        finally:
+            metrics.set_metrics(None)
+        self.assertGreater(m.counter('packets.decoded'), 0)
+        self.assertFalse(metrics.get_metrics().enabled)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,9 +1,29 @@
+import io
+import itertools
+import mmap
 import unittest
 from mot import MotObject, ContentType
 from msc.datagroups import *
 from msc.packets import *
 from bitarray import bitarray
-from msc import bitarray_to_hex
+from msc import bitarray_to_hex, int_to_bitarray, calculate_crc
+
+def reference_tobytes(packet):
+    """bit-by-bit reference encoding of a packet"""
+    bits = bitarray()
+    bits += int_to_bitarray(packet.size // 24 - 1, 2)
+    bits += int_to_bitarray(packet.index, 2)
+    bits += bitarray('1' if packet.first else '0')
+    bits += bitarray('1' if packet.last else '0')
+    bits += int_to_bitarray(packet.address, 10)
+    bits += bitarray('0')
+    bits += int_to_bitarray(len(packet.data), 7)
+    tmp = bitarray()
+    tmp.frombytes(packet.data)
+    bits += tmp
+    bits += bitarray('0' * (packet.size - len(packet.data) - 5) * 8)
+    bits += int_to_bitarray(calculate_crc(bits.tobytes()), 16)
+    return bits.tobytes()
 
 class Test(unittest.TestCase):
 
@@ -24,6 +44,104 @@ class Test(unittest.TestCase):
             tmp.frombytes(packet.tobytes())
             # TODO test packet bytes
 
+    def test_tobytes_equivalence(self):
+        """testing byte encoder against the bitwise reference encoding"""
+
+        for size, address, length, first, last, index in [
+                (Packet.SIZE_24, 1, 0, True, True, 0),
+                (Packet.SIZE_48, 1023, 43, False, True, 3),
+                (Packet.SIZE_72, 256, 10, True, False, 1),
+                (Packet.SIZE_96, 513, 91, False, False, 2)]:
+            packet = Packet(size, address, bytes(range(length)), first, last, index)
+            self.assertEqual(packet.tobytes(), reference_tobytes(packet))
+
+    def test_frombytes_roundtrip(self):
+        """testing packets parse back from bytes and bitarrays"""
+
+        packet = Packet(Packet.SIZE_72, 700, b"\x01\x02\x03", True, False, 2)
+        buf = b"\x00" + packet.tobytes()
+        for decoded in [Packet.frombytes(buf, 1), Packet.frombits(bitarray(''.join('{0:08b}'.format(x) for x in buf)), i=8)]:
+            self.assertEqual(decoded.size, Packet.SIZE_72)
+            self.assertEqual(decoded.address, 700)
+            self.assertEqual(decoded.data, b"\x01\x02\x03")
+            self.assertTrue(decoded.first)
+            self.assertFalse(decoded.last)
+            self.assertEqual(decoded.index, 2)
+
+    def test_decoder_feed(self):
+        """testing the stateful decoder over arbitrary chunk boundaries"""
+
+        packets = [Packet(size, i + 1, bytes([i]) * (size - 5), True, True, i % 4) for i, size in enumerate(Packet.sizes * 50)]
+        data = b"".join(packet.tobytes() for packet in packets)
+
+        decoder = PacketDecoder(buffer_size=100)
+        decoded = []
+        for i in range(0, len(data), 37):
+            decoder.feed(data[i:i+37])
+            decoded.extend(decoder)
+        self.assertEqual(len(decoder), 0)
+        self.assertEqual([(p.size, p.address, p.data) for p in decoded], [(p.size, p.address, p.data) for p in packets])
+
+    def test_decode_mmap(self):
+        """testing decoding from an mmap yields packets with views into it"""
+
+        packets = [Packet(size, i + 1, bytes([i]) * (size - 5), True, True, i % 4) for i, size in enumerate(Packet.sizes * 10)]
+        data = b"".join(packet.tobytes() for packet in packets)
+        capture = mmap.mmap(-1, len(data))
+        capture.write(data)
+
+        decoded = list(decode_packets(capture))
+        self.assertEqual([(p.size, p.address, p.data) for p in decoded], [(p.size, p.address, p.data) for p in packets])
+        self.assertIsInstance(decoded[0].data, memoryview)
+        self.assertIs(decoded[0].data.obj, capture)
+        del decoded
+        capture.close()
+
+    def test_decoder_resync(self):
+        """testing the decoder skips a corrupted packet"""
+
+        packets = [Packet(Packet.SIZE_48, 1, b"\x00" * 43, True, True, i % 4) for i in range(4)]
+        data = bytearray(b"".join(packet.tobytes() for packet in packets))
+        data[48 + 10] ^= 0xff
+        errors = []
+        decoded = list(decode_packets(io.BytesIO(bytes(data)), error_callback=errors.append))
+        self.assertEqual([p.index for p in decoded], [0, 2, 3])
+        self.assertEqual(len(errors), 1)
+
+    def test_decoder_resync_noise(self):
+        """testing the decoder relocks after noise and counts the bytes skipped"""
+
+        packets = [Packet(Packet.SIZE_96, 5, bytes([i]) * 91, True, True, i % 4) for i in range(10)]
+        data = b"".join(packet.tobytes() for packet in packets[:5]) + b"\xff" * 30 + b"".join(packet.tobytes() for packet in packets[5:])
+
+        decoder = PacketDecoder(addresses=[5])
+        decoded = list(decoder.decode(io.BytesIO(data)))
+        self.assertEqual([p.data for p in decoded], [p.data for p in packets])
+        self.assertEqual(decoder.resyncs, 1)
+        self.assertEqual(decoder.bytes_skipped, 30)
+        self.assertTrue(decoder.locked)
+        self.assertEqual(decoder.bytes_to_lock, 30)
+
+    def test_iter_packets_endless(self):
+        """testing packets are generated lazily from an endless datagroup cycle"""
+
+        datagroups = [Datagroup(1, 4, bytes([0, 100]) + bytes(100), i, i) for i in range(3)]
+        packets = list(itertools.islice(iter_packets(itertools.cycle(datagroups), 5), 100))
+        self.assertEqual(len(packets), 100)
+        self.assertEqual([p.index for p in packets[:6]], [0, 1, 2, 3, 0, 1])
+
+        encoded = list(itertools.islice(iter_packets(itertools.cycle(datagroups), 5, raw=True), 100))
+        self.assertEqual(encoded, [p.tobytes() for p in packets])
+
+    def test_iter_packets_padding(self):
+        """testing padding packets end the continuity index on 3"""
+
+        datagroups = [Datagroup(1, 4, bytes([0, 10]) + bytes(10), 0, 0)]
+        continuity = {}
+        packets = list(iter_packets(datagroups, 5, continuity=continuity, padding=True))
+        self.assertEqual([p.index for p in packets], [0, 1, 2, 3])
+        self.assertEqual([len(p.data) for p in packets[1:]], [0, 0, 0])
+        self.assertEqual(continuity[5], 3)
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,102 @@
+import os
+import random
+import tempfile
+import unittest
+from mot import MotObject, ContentType
+from msc.datagroups import encode_headermode, encode_directorymode, DatagroupReassembler, DIRECTORY_UNCOMPRESSED
+from msc.packets import encode_packets, decode_packets
+from msc.parallel import ParallelEncoder, ParallelDecoder
+
+class Test(unittest.TestCase):
+
+    def setUp(self):
+        self.objects = [MotObject("TestObject%d" % i, bytes([i]) * (5000 * i + 17), ContentType.IMAGE_JFIF) for i in range(8)]
+
+    def test_headermode(self):
+        """testing header mode datagroups encoded across workers match those encoded serially"""
+        serial = encode_headermode(self.objects)
+        parallel = encode_headermode(self.objects, workers=2)
+        self.assertEqual(len(serial), sum(len(encode_headermode(object)) for object in self.objects))
+        self.assertEqual([d.tobytes() for d in parallel], [d.tobytes() for d in serial])
+
+    def test_directorymode(self):
+        """testing directory mode body datagroups and directory match those encoded serially"""
+        serial = encode_directorymode(self.objects)
+        parallel = encode_directorymode(self.objects, workers=2)
+        transport_ids = [o.get_transport_id() for o in self.objects]
+        self.assertEqual([d.tobytes() for d in parallel if d.get_transport_id() in transport_ids], [d.tobytes() for d in serial if d.get_transport_id() in transport_ids])
+        self.assertEqual([d.get_data() for d in parallel if d.get_type() == DIRECTORY_UNCOMPRESSED], [d.get_data() for d in serial if d.get_type() == DIRECTORY_UNCOMPRESSED])
+        self.assertEqual(len(parallel), len(serial))
+
+    def test_changed(self):
+        """testing datagroups encoded across workers encode again once changed"""
+        parallel = encode_headermode(self.objects, workers=2)
+        serial = encode_headermode(self.objects)
+        for datagroups in (parallel, serial):
+            datagroups[1].repetition = 3
+            datagroups[2].crc_enabled = False
+        self.assertEqual([d.tobytes() for d in parallel[:3]], [d.tobytes() for d in serial[:3]])
+
+    def test_packets(self):
+        """testing packets encoded across workers keep their continuity indices"""
+        datagroups = encode_headermode(self.objects)
+        continuity = {}
+        with ParallelEncoder(3) as encoder:
+            packets = encoder.encode_packets(datagroups, 5, 48, continuity)
+        self.assertEqual(packets, [p.tobytes() for p in encode_packets(datagroups, 5, 48)])
+        self.assertEqual(continuity[5], (len(packets) - 1) % 4)
+
+    def test_decode(self):
+        """testing a capture decoded in chunks across workers gives the same packets and datagroups"""
+        data = bytearray()
+        for address in (5, 6):
+            data += b"".join(p.tobytes() for p in encode_packets(encode_headermode(self.objects), address, 96))
+        for i in range(1001, len(data), 7919): data[i] ^= 0xff
+        f = tempfile.NamedTemporaryFile(delete=False)
+        f.write(data)
+        f.close()
+        self.addCleanup(os.remove, f.name)
+
+        serial = list(decode_packets(open(f.name, 'rb')))
+        decoder = ParallelDecoder(3, chunk_size=5000)
+        packets = decoder.decode_packets(f.name)
+        self.assertEqual([p.tobytes() for o, p in packets], [p.tobytes() for p in serial])
+        datagroups = decoder.decode_datagroups(f.name)
+        reassembler = DatagroupReassembler()
+        expected = list(reassembler.reassemble(serial))
+        self.assertEqual([(a, d.tobytes()) for a, d in datagroups], [(a, d.tobytes()) for a, d in expected])
+        self.assertEqual(sorted(decoder.states), [5, 6])
+        for address, state in reassembler.states.items():
+            self.assertEqual(str(decoder.states[address]), str(state))
+        self.assertGreater(decoder.crc_errors, 0)
+
+    def test_decode_interleaved(self):
+        """testing continuity is counted across chunk edges for addresses interleaved with dropped packets and garbage"""
+        datagroups = encode_headermode(self.objects)
+        rng = random.Random(2)
+        runs = [encode_packets(datagroups, 5, 96), encode_packets(datagroups, 6, 48)]
+        data = bytearray()
+        while any(runs):
+            run = rng.choice([run for run in runs if run])
+            packet = run.pop(0)
+            r = rng.random()
+            if r < 0.02: continue
+            if r < 0.05: data += bytes(rng.randrange(256) for i in range(rng.randrange(1, 40)))
+            data += packet.tobytes()
+        f = tempfile.NamedTemporaryFile(delete=False)
+        f.write(data)
+        f.close()
+        self.addCleanup(os.remove, f.name)
+
+        reassembler = DatagroupReassembler()
+        expected = list(reassembler.reassemble(decode_packets(open(f.name, 'rb'))))
+        for chunk_size in (1000, 3000, 5000):
+            decoder = ParallelDecoder(2, chunk_size=chunk_size)
+            datagroups = decoder.decode_datagroups(f.name)
+            self.assertEqual([(a, d.tobytes()) for a, d in datagroups], [(a, d.tobytes()) for a, d in expected])
+            for address, state in reassembler.states.items():
+                self.assertGreater(state.continuity_errors, 0)
+                self.assertEqual(str(decoder.states[address]), str(state))
+
+if __name__ == "__main__":
+    unittest.main()
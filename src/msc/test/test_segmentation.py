@@ -1,6 +1,6 @@
 import unittest
 
-from msc.datagroups import _segment, ConstantSegmentSize, CompletionTriggerSegmentingStrategy
+from msc.datagroups import _segment, ConstantSegmentSize, CompletionTriggerSegmentingStrategy, PacketAlignedSegmentingStrategy, segment_padding
 
 
 class ConstantSegmentSizeTest(unittest.TestCase):
@@ -17,7 +17,26 @@ class ConstantSegmentSizeTest(unittest.TestCase):
         assert len(segments) == 2     
         assert len(segments[0]) == 8191
         assert len(segments[1]) == 7813   
-        
+
+    def test_view(self):
+        data = bytes(range(256)) * 100
+        segments = _segment(data, ConstantSegmentSize(1000))
+        assert all(segment.view.obj is data for segment in segments)
+        assert b"".join(segment.tobytes()[2:] for segment in segments) == data
+        assert segments[-1].tobytes()[:2] == b"\x02\x58"
+
+    def test_compare(self):
+        data = bytes(range(256)) * 100
+        segments = _segment(data, ConstantSegmentSize(1000))
+        expected = segments[1].tobytes()
+        assert segments[1] == expected and expected == segments[1]
+        assert segments[1] != segments[2] and segments[1] != expected[:-1]
+        assert segments[1] == _segment(data, ConstantSegmentSize(1000))[1]
+        assert hash(segments[1]) == hash(expected)
+        assert [segments[1][i] for i in (0, 1, 2, -1)] == [expected[i] for i in (0, 1, 2, -1)]
+        assert segments[1][:4] == expected[:4] and segments[1][10:20] == expected[10:20] and segments[1][::7] == expected[::7]
+        self.assertRaises(IndexError, lambda: segments[1][1002])
+
 class CompletionTriggerSegmentingStrategyTest(unittest.TestCase):
     
     def test_1(self):
@@ -52,5 +71,44 @@ class CompletionTriggerSegmentingStrategyTest(unittest.TestCase):
             total += len(segment)-2
         assert total == len(data)  
 
+    def test_plan(self):
+        strategy = CompletionTriggerSegmentingStrategy(64)
+        for length in (46, 1000, 16000, 1 << 20):
+            sizes = strategy.segment_sizes(length)
+            assert sum(sizes) == length
+            assert sizes[-1] <= 64
+            assert all(size == sizes[0] and size <= 8189 for size in sizes[:-1])
+        assert strategy.segment_sizes(1 << 20) is strategy.segment_sizes(1 << 20)
+        assert len(strategy.segment_sizes(1 << 20)) == 130
+
+    def test_plan_fallback(self):
+        for target in (1, 8):
+            sizes = CompletionTriggerSegmentingStrategy(target).segment_sizes(1214664)
+            assert sum(sizes) == 1214664
+            assert sizes[-1] == target
+            assert len(sizes) == 150
+            assert all(size == 8189 for size in sizes[:-2])
+
+    def test_segments(self):
+        data = b" " * 16000
+        segments = _segment(data, CompletionTriggerSegmentingStrategy(64, maximum_segment_size=1024))
+        assert [len(segment) - 2 for segment in segments] == CompletionTriggerSegmentingStrategy(64, maximum_segment_size=1024).segment_sizes(16000)
+        assert len(segments[-1]) - 2 <= 64
+
+class PacketAlignedSegmentingStrategyTest(unittest.TestCase):
+
+    def test_1(self):
+        data = b" " * 50000
+        segments = _segment(data, PacketAlignedSegmentingStrategy())
+        assert all((len(segment) + 9) % 91 == 0 for segment in segments[:-1])
+        assert segment_padding(segments[:-1]) == 0
+        assert segment_padding(segments) < segment_padding(_segment(data, ConstantSegmentSize()))
+
+    def test_2(self):
+        data = b" " * 16000
+        segments = _segment(data, PacketAlignedSegmentingStrategy(packet_size=24, maximum_segment_size=1024))
+        assert all(len(segment) - 2 <= 1024 for segment in segments)
+        assert all((len(segment) + 9) % 19 == 0 for segment in segments[:-1])
+
 if __name__ == "__main__":
     unittest.main()
@@ -1,10 +1,19 @@
+import asyncio
+import itertools
+import os
+import selectors
+import socket
+import tempfile
+import time
 import unittest
+import unittest.mock
 import urllib.request, urllib.error, urllib.parse
 
 from msc import calculate_crc
 from mot import MotObject, ContentType
-from msc.datagroups import encode_headermode
-from msc.transports import UdpTransport, FileTransport
+from msc.datagroups import encode_headermode, ConstantSegmentSize, DirectoryDatagroupEncoder
+from msc.packets import encode_packets
+from msc.transports import UdpTransport, AsyncUdpTransport, FileTransport, BufferedFileTransport
 
 url = 'http://owdo.thisisglobal.com/2.0/id/25/logo/320x240.jpg'
         
@@ -34,7 +43,139 @@ class UdpTransportTest(unittest.TestCase):
         transport = UdpTransport(address=('10.15.81.160', 5555))
         transport.start(callback)       
 
-        
+    def test_packets_per_frame(self):
+        """testing packets are coalesced into frames, with any remainder sent on stopping"""
+
+        receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        receiver.bind(('127.0.0.1', 0))
+        receiver.settimeout(1)
+        self.addCleanup(receiver.close)
+
+        object = MotObject("TestObject", b"\x00" * 800, ContentType.IMAGE_JFIF)
+        packets = encode_packets(encode_headermode([object]), 1, 96)
+        self.assertEqual(len(packets), 10)
+        transport = UdpTransport.fromurl('udp://127.0.0.1:%d/?packets_per_frame=4' % receiver.getsockname()[1])
+        i = iter(packets)
+        def callback():
+            try: return next(i)
+            except StopIteration: transport.stop()
+            return []
+        transport.start(callback)
+
+        frames = [receiver.recv(4096) for i in range(3)]
+        self.assertEqual([len(frame) for frame in frames], [sum(p.size for p in packets[i:i+4]) for i in range(0, 10, 4)])
+        self.assertEqual(b"".join(frames), b"".join(p.tobytes() for p in packets))
+
+    def test_packets_paced_before_datagroup(self):
+        """testing pending packets are paced for before a datagroup is sent after them"""
+
+        receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        receiver.bind(('127.0.0.1', 0))
+        self.addCleanup(receiver.close)
+
+        object = MotObject("TestObject", b"\x00" * 100, ContentType.IMAGE_JFIF)
+        datagroups = encode_headermode([object])
+        packets = encode_packets(datagroups[:1], 1, 96)
+        transport = UdpTransport(('127.0.0.1', receiver.getsockname()[1]), bitrate=8000, packets_per_frame=4)
+        data = [packets + datagroups[1:]]
+        def callback():
+            transport.stop()
+            return data.pop()
+
+        events = []
+        transport.send_frame = lambda b: events.append(('send', len(b)))
+        transport.flush = lambda: (events.append(('send', sum(len(b) for b in transport.pending))), transport.pending.clear()) if transport.pending else None
+        with unittest.mock.patch('time.sleep', lambda t: events.append(('sleep', round(t, 3)))):
+            transport.start(callback)
+        size = len(datagroups[1].tobytes())
+        self.assertEqual(events, [('send', sum(p.size for p in packets)), ('sleep', round(len(packets) * 0.024, 3)), ('send', size), ('sleep', round(size * 8 / 8000.0, 3))])
+
+    def test_no_data(self):
+        """testing a callback returning None waits a slot rather than spinning, until stopped"""
+
+        transport = UdpTransport(('127.0.0.1', 9), bitrate=8000)
+        data = [None, None, None]
+        def callback():
+            if len(data) == 1: transport.stop()
+            return data.pop()
+        sleeps = []
+        with unittest.mock.patch('time.sleep', sleeps.append):
+            transport.start(callback)
+        self.assertEqual(sleeps, [0.024, 0.024])
+        self.assertAlmostEqual(transport.output_time, 0.048)
+
+class AsyncUdpTransportTest(unittest.TestCase):
+
+    def test_fromurl(self):
+        transport = AsyncUdpTransport.fromurl('udp://10.15.81.160:5555/?bitrate=8192')
+        self.assertIsInstance(transport, AsyncUdpTransport)
+        self.assertEqual(transport.bitrate, 8192)
+
+    def run_with_fake_clock(self, coroutine):
+        """run a coroutine on a loop whose clock only moves on when it would otherwise wait"""
+        class Selector(selectors.DefaultSelector):
+            now = 0.0
+            def select(self, timeout=None):
+                if timeout: self.now += timeout
+                return selectors.DefaultSelector.select(self, 0)
+        selector = Selector()
+        loop = asyncio.SelectorEventLoop(selector)
+        loop.time = lambda: selector.now
+        self.addCleanup(loop.close)
+        loop.run_until_complete(coroutine)
+        return selector.now
+
+    def test_pacing(self):
+        """testing transports sharing a loop send everything at their configured bitrate"""
+
+        receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        receiver.bind(('127.0.0.1', 0))
+        receiver.settimeout(1)
+        self.addCleanup(receiver.close)
+
+        object = MotObject("TestObject", b"\x00" * 2000, ContentType.IMAGE_JFIF)
+        datagroups = encode_headermode([object], ConstantSegmentSize(200))
+        transports = [AsyncUdpTransport(receiver.getsockname(), bitrate=256000) for i in range(2)]
+        def callback(transport, i):
+            def f():
+                try: return next(i)
+                except StopIteration: transport.stop()
+                return []
+            return f
+        async def run():
+            await asyncio.gather(*[t.start(callback(t, iter(datagroups))) for t in transports])
+        elapsed = self.run_with_fake_clock(run())
+
+        received = [receiver.recv(1024) for i in range(2 * len(datagroups))]
+        self.assertEqual(sorted(received), sorted([d.tobytes() for d in datagroups] * 2))
+        self.assertAlmostEqual(elapsed, sum(len(d.tobytes()) for d in datagroups) * 8.0 / 256000)
+        for transport in transports:
+            self.assertEqual(transport.frames_sent, len(datagroups))
+            self.assertEqual(transport.late_frames, 0)
+            self.assertAlmostEqual(transport.achieved_bitrate, transport.bitrate, delta=1)
+
+    def test_no_data(self):
+        """testing a callback returning None waits a slot at a time until it returns data, without catching up afterwards"""
+
+        receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        receiver.bind(('127.0.0.1', 0))
+        receiver.settimeout(1)
+        self.addCleanup(receiver.close)
+
+        object = MotObject("TestObject", b"\x00" * 100, ContentType.IMAGE_JFIF)
+        datagroups = encode_headermode([object])
+        transport = AsyncUdpTransport(receiver.getsockname(), bitrate=256000)
+        data = [datagroups, None, None, datagroups]
+        def callback():
+            if len(data) == 1: transport.stop()
+            return data.pop()
+        elapsed = self.run_with_fake_clock(transport.start(callback))
+
+        self.assertEqual([receiver.recv(1024) for d in datagroups * 2], [d.tobytes() for d in datagroups * 2])
+        self.assertEqual(transport.frames_sent, 2 * len(datagroups))
+        self.assertEqual(transport.late_frames, 0)
+        self.assertAlmostEqual(elapsed, 2 * 0.024 + 2 * sum(len(d.tobytes()) for d in datagroups) * 8.0 / 256000)
+
 class FileTransportTest(unittest.TestCase):
     
     def test_fromurl(self):
@@ -42,28 +183,74 @@ class FileTransportTest(unittest.TestCase):
         transport = FileTransport.fromurl('file:///%s/out.dat' % os.path.curdir)
 
     def test_encode_slide_to_file(self):
-        url = 'http://owdo.thisisglobal.com/2.0/id/25/logo/320x240.jpg'
-        req = urllib.request.Request(url)
-        response = urllib.request.urlopen(req)
-        data = response.read()
+        data = bytes(bytearray(i % 256 for i in range(20000)))
         type = ContentType.IMAGE_JFIF
                 
         # create MOT object
-        object = MotObject(url, data, type)
+        object = MotObject('TestSlide', data, type)
             
         # encode object
         datagroups = encode_headermode([object])
 
-        # define callback
-        i = iter(datagroups)
+        # define callback, sending all the datagroups once
         def callback():
-            return next(i)
+            transport.stop()
+            return datagroups
 
         import io
-        s = io.StringIO()
+        class Output(io.BytesIO):
+            def close(self):
+                self.value = self.getvalue()
+                io.BytesIO.close(self)
+        s = Output()
         transport = FileTransport(s)
         transport.start(callback)       
+        self.assertEqual(s.value, b''.join(d.tobytes() for d in datagroups))
+
+class BufferedFileTransportTest(unittest.TestCase):
+
+    def test_render(self):
+        """testing rendering output time to rotated files, with and without a background writer"""
+
+        encoder = DirectoryDatagroupEncoder()
+        encoder.set([MotObject("TestObject%d" % i, bytes([i]) * 3000, ContentType.IMAGE_JFIF) for i in range(4)])
+        expected = b"".join(d.tobytes() for d in encoder.datagroups)
+
+        directory = tempfile.mkdtemp()
+        outputs = []
+        for background in (False, True):
+            path = os.path.join(directory, 'out%s-{index}.dat' % background)
+            transport = BufferedFileTransport(path, bitrate=8192, block_size=4096, background=background, rotate_time=10)
+            datagroups = itertools.cycle(encoder.datagroups)
+            written = transport.render(lambda: next(datagroups), 60)
+            self.assertGreaterEqual(transport.output_time, 60)
+            self.assertEqual(transport.index, 5)
+            files = [open(path.format(index=i), 'rb').read() for i in range(6)]
+            self.assertEqual(sum(len(f) for f in files), written)
+            outputs.append(b"".join(files))
+            for i in range(6): os.remove(path.format(index=i))
+        os.rmdir(directory)
+
+        self.assertEqual(outputs[0], outputs[1])
+        self.assertTrue(outputs[0].startswith(expected * (len(outputs[0]) // len(expected))))
+
+    def test_write_error(self):
+        """testing a failing write in the background writer is raised rather than blocking"""
+
+        class FailingFile:
+            name = 'failing'
+            def write(self, data):
+                time.sleep(0.1) # long enough for the queue to fill
+                raise IOError('no space left on device')
+            def close(self): pass
 
+        encoder = DirectoryDatagroupEncoder()
+        encoder.set([MotObject("TestObject%d" % i, bytes([i]) * 3000, ContentType.IMAGE_JFIF) for i in range(4)])
+        datagroups = itertools.cycle(encoder.datagroups)
+        transport = BufferedFileTransport(FailingFile(), block_size=24, background=True)
+        with self.assertRaises(IOError):
+            transport.render(lambda: next(datagroups), 3600)
+        self.assertIsNone(transport.thread)
 
 if __name__ == "__main__":
     unittest.main()
@@ -1,9 +1,13 @@
+import asyncio
+import queue
 import socket
+import threading
 import time
 import datetime
 import logging
 
 from msc.datagroups import Datagroup
+from msc.metrics import get_metrics
 from msc.packets import Packet
 
 def elapsed_from_clock():
@@ -22,16 +26,15 @@ class BlockingTransportMixin:
 
     def clock(self): return elapsed_from_clock().__next__
 
-class UdpTransport(NonBlockingTransportMixin):
-    """Send data over a UDP socket either as Datagroups or DAB Packets"""
+class UdpTransportMixin(NonBlockingTransportMixin):
+    """Defines the URI form, clock and metrics shared by the UDP transports"""
 
     logger = logging.getLogger('msc.transports.udp')
-    
-    DATAGROUPS = 1
-    PACKETS = 2
-    
-    @staticmethod
-    def fromurl(url, logger=logger):
+
+    IDLE_TIME = 0.024 # seconds to wait when the callback has nothing to send, being one packet slot
+
+    @classmethod
+    def fromurl(cls, url, logger=logger):
         """
         Parse this transport from its URI representation.
 
@@ -45,6 +48,7 @@ class UdpTransport(NonBlockingTransportMixin):
         Currently, the following parameters are defined:
 
         * bitrate: transport bitrate in bps (default 16kbps)
+        * packets_per_frame: number of packets to coalesce into each UDP frame (default 1)
         """
         from urllib.parse import urlparse, parse_qsl
         if isinstance(url, str): url = urlparse(url)
@@ -52,19 +56,57 @@ class UdpTransport(NonBlockingTransportMixin):
         if url.path.find('?') >=0 : kwargs = dict(parse_qsl(url.path[url.path.index('?')+1:]))
         else: kwargs = dict(parse_qsl(url.query))
 
-        return UdpTransport((url.hostname, url.port), logger=logger, **kwargs)
+        return cls((url.hostname, url.port), logger=logger, **kwargs)
+
+    def _sent(self, n):
+        self.metrics.increment('transport.frames_sent', transport='udp')
+        self.metrics.increment('transport.bytes_sent', n, transport='udp')
+
+    def clock(self):
+        class Iter:
+            def __init__(self, transport):
+                self.transport = transport
+            def __iter__(self):
+                return self
+            def __next__(self):
+                r = self.transport.elapsed
+                self.transport.elapsed = datetime.timedelta(0)
+                return r
+        return Iter(self).__next__
+
+    def __str__(self):
+        return 'udp://{address}'.format(address=self.address)
+
+class UdpTransport(UdpTransportMixin):
+    """
+    Send data over a UDP socket either as Datagroups or DAB Packets
+
+    The frames and bytes sent are counted in the metrics, along with the pacing drift,
+    being how far the wall clock is behind the output time sent after each sleep.
+    """
+
+    logger = logging.getLogger('msc.transports.udp')
+    
+    DATAGROUPS = 1
+    PACKETS = 2
     
-    def __init__(self, address, bitrate=16384, logger=logger):
+    def __init__(self, address, bitrate=16384, packets_per_frame=1, logger=logger, metrics=None):
         """
         address: UDP address as (host, port) tuple
         bitrate: bitrate to send data in bps
+        packets_per_frame: number of packets to coalesce into each UDP frame
+        metrics: metrics to count frames and pacing drift in, by default the default metrics
         """
         self.address = address
         self.logger.info('sending UDP frames to address: ${address}, bitrate={bitrate} bps'.format(address=address, bitrate=bitrate))
         self.bitrate = int(bitrate) if bitrate else bitrate
+        self.packets_per_frame = max(1, int(packets_per_frame))
         self.logger = logger
         self.elapsed = datetime.timedelta(0)
         self.started = False
+        self.pending = [] # packets waiting to be coalesced into a frame
+        self.metrics = metrics if metrics is not None else get_metrics()
+        self.output_time = 0.0 # seconds of output sent since starting
         
     def start(self, callback):
         if self.started: raise ValueError('transport already started')
@@ -74,47 +116,179 @@ class UdpTransport(NonBlockingTransportMixin):
         self.started = True
         self.sock = socket.socket(socket.AF_INET, # Internet
                                   socket.SOCK_DGRAM) # UDP
+        started_at = time.monotonic()
+        self.output_time = 0.0
         
         try:
             while self.started: 
                 data = callback()
-                if not isinstance(data, list): data = [data]
+                if data is None: data = []
+                elif not isinstance(data, list): data = [data]
+                if not data and self.started:
+                    # nothing to send, so wait a slot rather than spinning on the callback
+                    self.output_time += UdpTransportMixin.IDLE_TIME
+                    time.sleep(UdpTransportMixin.IDLE_TIME)
                 for d in data:
                     b = d.tobytes()
                     if isinstance(d, Datagroup):
+                        self._send_pending(started_at)
                         self.send_frame(b)
                         t = datetime.timedelta(milliseconds=(8 * float(len(b)) * 1000)/self.bitrate)
                         self.elapsed += t 
+                        self.output_time += t.total_seconds()
                         time.sleep(t.seconds + t.microseconds / 1e6)
+                        if self.metrics.enabled: self.metrics.observe('transport.drift', time.monotonic() - started_at - self.output_time, transport='udp')
                     elif isinstance(d, Packet):
-                        self.send_frame(b)
-                        t = datetime.timedelta(milliseconds=24)
-                        self.elapsed += t 
-                        time.sleep(t.seconds + t.microseconds / 1e6)
+                        self.pending.append(b)
+                        self.elapsed += datetime.timedelta(milliseconds=24)
+                        self.output_time += 0.024
+                        if len(self.pending) >= self.packets_per_frame: self._send_pending(started_at)
                     else: raise TypeError('neither a datagroup nor packet be this be: %s', type(d))
-        finally: self.sock.close()
+        finally: 
+            self.flush()
+            self.sock.close()
+
+    def _send_pending(self, started_at):
+        """send any packets waiting to be coalesced, pacing for all the packets in the frame at once"""
+        n = len(self.pending)
+        if not n: return
+        self.flush()
+        time.sleep(n * 0.024)
+        if self.metrics.enabled: self.metrics.observe('transport.drift', time.monotonic() - started_at - self.output_time, transport='udp')
 
     def send_frame(self, data):
         self.sock.sendto(data, self.address)
+        if self.metrics.enabled: self._sent(len(data))
+
+    def flush(self):
+        """send any packets waiting to be coalesced, gathered into one frame without
+           joining them where the socket supports it"""
+        if not self.pending: return
+        if len(self.pending) == 1: self.send_frame(self.pending[0])
+        elif hasattr(self.sock, 'sendmsg'):
+            self.sock.sendmsg(self.pending, [], 0, self.address)
+            if self.metrics.enabled: self._sent(sum(len(b) for b in self.pending))
+        else: self.send_frame(b''.join(self.pending))
+        self.pending = []
     
     def stop(self):
         self.started = False
+                    
+class AsyncUdpTransport(UdpTransportMixin, asyncio.DatagramProtocol):
+    """
+    Send data over UDP either as Datagroups or DAB Packets from an asyncio event loop,
+    so that many transports can share one loop
 
-    def clock(self):
-        class Iter:
-            def __init__(self, transport):
-                self.transport = transport
-            def __iter__(self):
-                return self
-            def __next__(self):
-                r = self.transport.elapsed
-                self.transport.elapsed = datetime.timedelta(0)
-                return r
-        return Iter(self).__next__
+    Each frame is paced against a deadline on the monotonic loop clock, advanced by
+    the duration of each frame. When a frame goes out late the next deadline is not
+    pushed back, so the transport catches up rather than drifting.
+    """
+
+    logger = logging.getLogger('msc.transports.udp')
+
+    def __init__(self, address, bitrate=16384, packets_per_frame=1, logger=logger, metrics=None):
+        """
+        address: UDP address as (host, port) tuple
+        bitrate: bitrate to send data in bps
+        packets_per_frame: number of packets to coalesce into each UDP frame
+        metrics: metrics to count frames and pacing drift in, by default the default metrics
+        """
+        self.address = address
+        self.bitrate = int(bitrate) if bitrate else bitrate
+        self.packets_per_frame = max(1, int(packets_per_frame))
+        self.pending = [] # packets waiting to be coalesced into a frame
+        self.logger = logger
+        self.logger.info('sending UDP frames to address: {address}, bitrate={bitrate} bps'.format(address=address, bitrate=bitrate))
+        self.elapsed = datetime.timedelta(0)
+        self.started = False
+        self.transport = None
+        self.bytes_sent = 0
+        self.frames_sent = 0
+        self.late_frames = 0
+        self.metrics = metrics if metrics is not None else get_metrics()
+        self._started_at = None
+        self._stopped_at = None
+        self._loop = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def error_received(self, exc):
+        self.logger.warning('error sending UDP frame to %s: %s', self.address, exc)
+
+    async def start(self, callback):
+        """
+        Send the data returned by the callback until stopped. The callback may return
+        a Datagroup or Packet, a list of them, None for no data, or a coroutine giving
+        any of these.
+        """
+        if self.started: raise ValueError('transport already started')
+        if not callback: raise ValueError('must define a valid callback')
+        self.logger.info('starting asynchronous UDP sender with callback: %s', callback)
+
+        self.started = True
+        self._loop = asyncio.get_running_loop()
+        await self._loop.create_datagram_endpoint(lambda: self, remote_addr=self.address)
+        deadline = self._started_at = self._loop.time()
+        self._stopped_at = None
+        try:
+            while self.started:
+                data = callback()
+                if asyncio.iscoroutine(data): data = await data
+                if data is None: data = []
+                elif not isinstance(data, list): data = [data]
+                for d in data:
+                    if isinstance(d, Datagroup):
+                        b = d.tobytes()
+                        t = 8 * float(len(b)) / self.bitrate
+                        self.flush()
+                        self.send_frame(b)
+                    elif isinstance(d, Packet):
+                        t = 0.024
+                        self.pending.append(d.tobytes())
+                    else: raise TypeError('neither a datagroup nor packet: %s' % type(d))
+                    self.elapsed += datetime.timedelta(seconds=t)
+                    deadline += t
+                    if len(self.pending) and len(self.pending) < self.packets_per_frame: continue
+                    self.flush()
+                    delay = deadline - self._loop.time()
+                    if delay < 0:
+                        self.late_frames += 1
+                        self.metrics.increment('transport.late_frames', transport='udp')
+                    await asyncio.sleep(max(delay, 0)) # always yield to other transports on the loop
+                    if self.metrics.enabled: self.metrics.observe('transport.drift', self._loop.time() - deadline, transport='udp')
+                if not data and self.started:
+                    # nothing to send, so wait a slot, without catching up on the idle time afterwards
+                    deadline = max(deadline, self._loop.time()) + UdpTransportMixin.IDLE_TIME
+                    await asyncio.sleep(deadline - self._loop.time())
+        finally:
+            self.flush()
+            self.started = False
+            self._stopped_at = self._loop.time()
+            self.transport.close()
+
+    def send_frame(self, data):
+        self.transport.sendto(data)
+        self.bytes_sent += len(data)
+        self.frames_sent += 1
+        if self.metrics.enabled: self._sent(len(data))
+
+    def flush(self):
+        """send any packets waiting to be coalesced into a frame"""
+        if not self.pending: return
+        self.send_frame(self.pending[0] if len(self.pending) == 1 else b''.join(self.pending))
+        self.pending = []
+
+    def stop(self):
+        self.started = False
+
+    @property
+    def achieved_bitrate(self):
+        """bitrate achieved since starting, in bps, to compare with the configured bitrate"""
+        if self._started_at is None: return 0
+        elapsed = (self._stopped_at or self._loop.time()) - self._started_at
+        return 8 * self.bytes_sent / elapsed if elapsed > 0 else 0
 
-    def __str__(self):
-        return 'udp://{address}'.format(address=self.address)
-                    
 class FileTransport(NonBlockingTransportMixin):
     
     logger = logging.getLogger('msc.transports.file')
@@ -144,14 +318,16 @@ class FileTransport(NonBlockingTransportMixin):
         else: kwargs = dict(parse_qsl(url.query))
         return FileTransport(open(path, 'wb'), logger=logger, **kwargs)
 
-    def __init__(self, f, bitrate=8192, logger=logger):
+    def __init__(self, f, bitrate=8192, logger=logger, metrics=None):
         self.logger = logger
         self.logger.info('sending output to file: ${file}, bitrate={bitrate} bps'.format(file=f, bitrate=bitrate))
         self.f = f
+        self.path = getattr(f, 'name', f)
         self.bitrate = int(bitrate) if bitrate else bitrate
         self.elapsed = datetime.timedelta(0)
         self.started = False
         self.notification = None
+        self.metrics = metrics if metrics is not None else get_metrics()
 
     def stop(self):
         self.started = False
@@ -169,12 +345,13 @@ class FileTransport(NonBlockingTransportMixin):
                 for d in data: 
                     b = d.tobytes()
                     if isinstance(d, Datagroup):
-                        self.f.write(b.decode('ascii'))
+                        self.f.write(b)
                         self.elapsed += datetime.timedelta(milliseconds=(8 * float(len(b)) * 1000)/self.bitrate)
                     elif isinstance(d, Packet):
-                        self.f.write(b.decode('ascii'))
+                        self.f.write(b)
                         self.elapsed += datetime.timedelta(milliseconds=24)
                     else: raise TypeError('yarrgh. neither a datagroup nor packet this be: %s', type(d))
+                    if self.metrics.enabled: self.metrics.increment('transport.bytes_sent', len(b), transport='file')
                 self.f.flush()
         finally: self.f.close()
 
@@ -193,3 +370,196 @@ class FileTransport(NonBlockingTransportMixin):
 
     def __str__(self):
         return 'file://{path}'.format(path=self.path)
+
+class BufferedFileTransport(FileTransport):
+    """
+    Write data to a binary file in large blocks rather than for each datagroup or
+    packet, optionally from a background writer thread, rotating to a new file by
+    size or by output time.
+
+    Output time is counted from the bitrate for datagroups and as 24ms for each
+    packet, as for the FileTransport, so that a number of seconds of output can be
+    rendered as fast as it can be encoded.
+    """
+
+    logger = logging.getLogger('msc.transports.file')
+
+    @staticmethod
+    def fromurl(url, logger=logger):
+        """
+        Parse this transport from its URI representation.
+
+        This should be of the form:
+
+            file:///<path>[?[parameter=value]...]
+
+        Where the parameters are defined as keyword arguments to the constructor.
+        """
+        from urllib.parse import urlparse, parse_qsl
+        if isinstance(url, str): url = urlparse(url)
+        if url.scheme != 'file': raise ValueError('url must begin with the file scheme')
+        path = url.path[:url.path.index('?')] if url.path.find('?') >= 0 else url.path
+        path = path.strip()
+        if url.path.find('?') >= 0: kwargs = dict(parse_qsl(url.path[url.path.index('?')+1:]))
+        else: kwargs = dict(parse_qsl(url.query))
+        return BufferedFileTransport(path, logger=logger, **kwargs)
+
+    def __init__(self, f, bitrate=8192, block_size=65536, background=False, rotate_size=None, rotate_time=None, logger=logger, metrics=None):
+        """
+        f: path of the file to write, or a binary file object to write to without rotation.
+           A path may contain an {index} field to number rotated files, otherwise they
+           are numbered by suffix
+        bitrate: transport bitrate in bps
+        block_size: size in bytes of the blocks written to the file
+        background: write the blocks from a background thread
+        rotate_size: size in bytes to rotate to a new file at
+        rotate_time: output time in seconds to rotate to a new file after
+        metrics: metrics to count bytes, blocks and rotations in, by default the default metrics
+        """
+        if not hasattr(f, 'write'):
+            self.pattern = f
+            f = open(self._filename(0), 'wb')
+        else:
+            if rotate_size or rotate_time: raise ValueError('rotation needs a path to open new files at')
+            self.pattern = None
+        FileTransport.__init__(self, f, bitrate=bitrate, logger=logger, metrics=metrics)
+        self.block_size = int(block_size)
+        self.background = str(background).lower() in ('1', 'true', 'yes')
+        self.rotate_size = int(rotate_size) if rotate_size else None
+        self.rotate_time = float(rotate_time) if rotate_time else None
+        self.buf = bytearray()
+        self.index = 0
+        self.bytes_written = 0
+        self.output_time = 0.0
+        self.file_bytes = 0
+        self.file_time = 0.0
+        self.queue = None
+        self.thread = None
+        self._error = None
+
+    def _filename(self, index):
+        if '{index}' in self.pattern: return self.pattern.format(index=index)
+        return self.pattern if not index else '%s.%d' % (self.pattern, index)
+
+    def _writer(self):
+        """
+        background writer, writing blocks and switching to rotated files in order
+
+        After an error the rest of the queue is drained and discarded until the writer
+        is closed, so that nothing waiting on the queue blocks, and the error is raised
+        to the caller on its next write or on closing.
+        """
+        f = self.f
+        try:
+            while True:
+                item = self.queue.get()
+                if item is None: return
+                if isinstance(item, bytes): f.write(item)
+                else:
+                    f.close()
+                    f = item
+        except Exception as e:
+            self._error = e
+            self.logger.exception('error writing to file')
+        finally:
+            f.close()
+        while True:
+            item = self.queue.get()
+            if item is None: break
+            if not isinstance(item, bytes): item.close()
+
+    def _write(self, data):
+        if self._error is not None: raise self._error
+        if self.queue is not None: self.queue.put(data)
+        else: self.f.write(data)
+
+    def write(self, b, t):
+        """add the bytes of a datagroup or packet taking the given output time"""
+        if (self.rotate_size and self.file_bytes and self.file_bytes + len(b) > self.rotate_size) or \
+           (self.rotate_time and self.file_time >= self.rotate_time):
+            self.rotate()
+        self.buf += b
+        self.bytes_written += len(b)
+        self.file_bytes += len(b)
+        self.output_time += t
+        self.file_time += t
+        self.elapsed += datetime.timedelta(seconds=t)
+        if self.metrics.enabled: self.metrics.increment('transport.bytes_sent', len(b), transport='file')
+        if len(self.buf) >= self.block_size:
+            n = len(self.buf) - len(self.buf) % self.block_size
+            self._write(bytes(self.buf[:n]))
+            del self.buf[:n]
+            self.metrics.increment('transport.blocks_written', transport='file')
+
+    def add(self, d):
+        """add a datagroup or packet"""
+        if isinstance(d, Datagroup):
+            b = d.tobytes()
+            self.write(b, 8 * float(len(b)) / self.bitrate)
+        elif isinstance(d, Packet):
+            self.write(d.tobytes(), 0.024)
+        else: raise TypeError('neither a datagroup nor packet: %s' % type(d))
+
+    def flush(self):
+        """write out whatever is buffered, whether a whole block or not"""
+        if self.buf: self._write(bytes(self.buf))
+        self.buf = bytearray()
+
+    def rotate(self):
+        """continue writing to the next file"""
+        self.flush()
+        self.index += 1
+        f = open(self._filename(self.index), 'wb')
+        self.logger.debug('rotating output to file: %s', f.name)
+        self.metrics.increment('transport.rotations', transport='file')
+        if self.queue is not None: self.queue.put(f)
+        else:
+            self.f.close()
+        self.f = f
+        self.path = f.name
+        self.file_bytes = 0
+        self.file_time = 0.0
+
+    def start(self, callback, duration=None):
+        """
+        Write the data returned by the callback until stopped, or until the given
+        number of seconds of output time have been written
+        """
+        if self.started: raise ValueError('transport already started')
+        if not callback: raise ValueError('must define a valid callback')
+        self.logger.info('starting buffered file transport with callback: %s', callback)
+        self.started = True
+        if self.background:
+            self.queue = queue.Queue(maxsize=64)
+            self.thread = threading.Thread(target=self._writer, name='msc-file-writer')
+            self.thread.daemon = True
+            self.thread.start()
+        try:
+            while self.started and (duration is None or self.output_time < duration):
+                data = callback()
+                if not data:
+                    if not self.started: break # stopped from the callback
+                    raise ValueError('no data or zero length data returned')
+                if not isinstance(data, list): data = [data]
+                for d in data: self.add(d)
+        finally:
+            self.started = False
+            self.close()
+
+    def render(self, callback, duration):
+        """Render the given number of seconds of output as fast as it can be encoded, returning the number of bytes written"""
+        self.start(callback, duration)
+        return self.bytes_written
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            if self.thread is not None:
+                self.queue.put(None)
+                self.thread.join()
+                self.thread = None
+                self.queue = None
+                if self._error is not None: raise self._error
+            else:
+                self.f.close()